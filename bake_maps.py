@@ -0,0 +1,18 @@
+import os
+
+from engine.assets import AssetPipeline
+from systems.tilemap import bake_tile_map
+
+'''
+Rebuilds the baked tile arrays for every map in assets/maps.
+Run this from the project root after changing a map, or the tile colors.
+'''
+def bake_all_maps(directory: str = 'maps'):
+    path = AssetPipeline.get_instance().get_path(directory)
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.png'):
+            map = bake_tile_map(os.path.join(directory, filename))
+            print(f'Baked {filename} ({map.shape[1]}x{map.shape[0]})')
+
+if __name__ == '__main__':
+    bake_all_maps()
@@ -1,2 +1,3 @@
+python bake_maps.py
 pyinstaller main.py
 cp assets dist/main/assets
\ No newline at end of file
@@ -1,12 +1,43 @@
+import collections
 import os.path
+import typing
 
 import pygame
 
 ROOT_DIR = os.getcwd()
 
+'''
+A bounded LRU cache of surfaces derived from a source (such as a surface or font).
+Each entry holds its source, so a source id in a key cannot be reused while the entry is cached.
+The cached surfaces are shared, and must not be drawn onto.
+'''
+class SurfaceCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: collections.OrderedDict[tuple, tuple[any, pygame.Surface]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, source: any, build: typing.Callable[[], pygame.Surface]) -> pygame.Surface:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        surface = build()
+        self.entries[key] = (source, surface)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return surface
+
+
 class AssetPipeline:
     __base_url: str = os.path.join(ROOT_DIR, "assets")
     asset_dict: dict[str, any] = dict()
+    scaled_cache: SurfaceCache = SurfaceCache(512)
+    text_cache: SurfaceCache = SurfaceCache(256)
 
     @staticmethod
     def get_instance():
@@ -30,6 +61,24 @@ class AssetPipeline:
 
         return image
     
+    '''
+    Returns a surface scaled by a factor, cached on the source surface and factor. See: SurfaceCache
+    '''
+    def get_scaled(self, surface: pygame.Surface, factor: float) -> pygame.Surface:
+        return self.scaled_cache.get((id(surface), factor), surface, lambda: pygame.transform.scale_by(surface, factor))
+
+    '''
+    Returns rendered text, cached on the font, text, color and antialiasing. See: SurfaceCache
+    '''
+    def render_text(self, font: pygame.font.Font, text: str, color: tuple[int, int, int], antialias: bool = True) -> pygame.Surface:
+        return self.text_cache.get((id(font), text, tuple(color), antialias), font, lambda: font.render(text, antialias, color))
+
+    '''
+    Returns the path of an asset on disk
+    '''
+    def get_path(self, key: str) -> str:
+        return self.__build_path(key)
+
     def __build_path(self, key: str):
         return os.path.join(self.__base_url, key)
         
\ No newline at end of file
@@ -0,0 +1,118 @@
+import abc
+import typing
+
+import numpy as np
+
+from .ecs import Entity, EntityGroup, HANDLE_SLOT_MASK
+
+'''
+Struct-of-arrays storage for component fields, indexed by entity slot.
+Each column is a numpy array with one row per slot, so systems can operate on every bound entity in a single vectorized pass.
+
+store = ColumnStore({ 'position': (np.float64, (2,)) })
+store.bind(entity)
+store.position[store.active_slots()] += 1
+'''
+class ColumnStore():
+    def __init__(self, columns: dict[str, tuple[typing.Any, tuple[int, ...]]], capacity: int = 64):
+        self.columns = columns
+        self.capacity = capacity
+        self.size = 0 # One past the highest slot that has been bound
+        self.active = np.zeros(capacity, dtype=bool)
+        self.entities: list[Entity | None] = [None] * capacity
+        for name, (dtype, shape) in columns.items():
+            setattr(self, name, np.zeros((capacity, *shape), dtype=dtype))
+
+    '''
+    Returns the array backing the named column
+    '''
+    def __getitem__(self, name: str) -> np.ndarray:
+        return getattr(self, name)
+
+    '''
+    Grows the columns (by doubling) until the slot fits
+    '''
+    def reserve(self, slot: int):
+        if slot < self.capacity:
+            return
+        capacity = self.capacity
+        while capacity <= slot:
+            capacity *= 2
+        self.active = np.resize(self.active, capacity)
+        self.active[self.capacity:] = False
+        self.entities.extend([None] * (capacity - self.capacity))
+        for name in self.columns:
+            column: np.ndarray = getattr(self, name)
+            grown = np.zeros((capacity, *column.shape[1:]), dtype=column.dtype)
+            grown[:self.capacity] = column
+            setattr(self, name, grown)
+        self.capacity = capacity
+
+    '''
+    Marks the slot of an entity as in use, and returns it
+    '''
+    def bind(self, e: Entity) -> int:
+        slot = e.handle & HANDLE_SLOT_MASK
+        self.reserve(slot)
+        self.active[slot] = True
+        self.entities[slot] = e
+        self.size = max(self.size, slot + 1)
+        return slot
+
+    '''
+    Releases the slot of an entity
+    '''
+    def unbind(self, e: Entity) -> int:
+        slot = e.handle & HANDLE_SLOT_MASK
+        self.active[slot] = False
+        self.entities[slot] = None
+        return slot
+
+    '''
+    Returns the indices of all slots in use
+    '''
+    def active_slots(self) -> np.ndarray:
+        return np.flatnonzero(self.active[:self.size])
+
+
+'''
+Base class for a component that reads and writes its fields through a ColumnStore.
+Views are swapped in for the original component while the entity is in the group (see: attach_column_store).
+'''
+class ColumnView(abc.ABC):
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, store: ColumnStore, slot: int):
+        self.store = store
+        self.slot = slot
+
+    '''
+    Returns a plain component holding the current values
+    '''
+    @abc.abstractmethod
+    def detach(self) -> typing.Any:
+        ...
+
+    '''
+    Views are copied out of the store. See: ecs.copy_component
+    '''
+    def copy(self) -> typing.Any:
+        return self.detach()
+
+
+'''
+Binds every entity with the named component to the store while it is in the group.
+On add, the component values are written into the columns and the component is replaced with a view.
+On removal, the view is replaced with a detached copy of the component.
+'''
+def attach_column_store(group: EntityGroup, component: str, store: ColumnStore, view: typing.Callable[[ColumnStore, int, typing.Any], ColumnView]):
+
+    def on_add(e: Entity):
+        slot = store.bind(e)
+        setattr(e, component, view(store, slot, getattr(e, component)))
+
+    def on_remove(e: Entity):
+        store.unbind(e)
+        setattr(e, component, getattr(e, component).detach())
+
+    group.observe(on_add, on_remove, component)
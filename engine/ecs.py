@@ -1,5 +1,6 @@
 import typing
 import dataclasses
+import time
 
 COMPONENT_COUNT = 0
 COMPONENT_INDICES = {}
@@ -39,6 +40,14 @@ def component_mask(components: tuple[str]):
             continue
     return mask
 
+'''
+Entity handles pack a slot index into the low bits, and the slot generation into the high bits.
+A handle goes stale once its entity is removed, as the slot generation is bumped when it is freed.
+'''
+NULL_HANDLE = -1
+HANDLE_SLOT_BITS = 20
+HANDLE_SLOT_MASK = (1 << HANDLE_SLOT_BITS) - 1
+
 '''
 Provides valid default arguments for components with mutable fields (required for python reasons)
 See @enumerate_component for examples.
@@ -46,6 +55,15 @@ See @enumerate_component for examples.
 def factory(constructor: typing.Callable[[],typing.Any]) -> typing.Any:
     return dataclasses.field(default_factory=constructor)
 
+'''
+Returns a shallow copy of a component.
+Components that are not dataclasses (such as views into column storage) must provide a copy() method.
+'''
+def copy_component(component: typing.Any) -> typing.Any:
+    if dataclasses.is_dataclass(component):
+        return dataclasses.replace(component)
+    return component.copy()
+
 '''
 An entity is a collection of components
 '''
@@ -53,6 +71,7 @@ class Entity():
     def __init__(self, name: str):
         self.name = name # Name for debugging
         self.mask = 0
+        self.handle = NULL_HANDLE # Assigned when added to a group
 
     def __repr__(self) -> str:
         return f"<Entity: {self.name}>"
@@ -72,27 +91,132 @@ class Entity():
     def clone(self) -> 'Entity':
         e = Entity(self.name)
         for key, value in vars(self).items():
-            if key not in ["name", "mask"]:
-                setattr(e, key, dataclasses.replace(value))
+            if key not in ENTITY_FIELDS:
+                setattr(e, key, copy_component(value))
+        return e
+
+# Entity attributes that are not components
+ENTITY_FIELDS = ("name", "mask", "handle")
+
+
+'''
+A template for stamping out entities.
+The component layout and mask are computed once, so instantiation is just an allocation plus field copies.
+Like Entity.clone, component fields are copied shallowly.
+
+prefab = Prefab(template)
+e = prefab.instantiate()
+e.motion.position = Vector2(x, y)
+group.add(e, prefab.mask)
+'''
+class Prefab():
+    def __init__(self, template: Entity):
+        self.name = template.name
+        self.layout = [
+            (key, component, type(component), tuple(f.name for f in dataclasses.fields(component)))
+            for key, component in vars(template).items() if key not in ENTITY_FIELDS
+        ]
+        self.mask = component_mask([key for key, _, _, _ in self.layout])
+
+    '''
+    Creates a new entity with copies of the template components
+    '''
+    def instantiate(self) -> Entity:
+        e = Entity(self.name)
+        e.mask = self.mask
+        for key, template, component_type, fields in self.layout:
+            component = component_type.__new__(component_type)
+            for field in fields:
+                setattr(component, field, getattr(template, field))
+            setattr(e, key, component)
         return e
     
     
+'''
+Caches a value derived from some inputs, so it is only recomputed when the inputs change.
+The inputs are compared by equality, so they should be snapshots (such as tuples, or revision counters) rather than mutable objects.
+This is meant to be stored as a field on the component holding the derived value.
+
+area = self.derived.get((cell_key(position), tilemap.revision), lambda: find_area(tilemap, position))
+'''
+class Derived():
+    UNSET = object()
+
+    def __init__(self):
+        self.inputs: typing.Any = Derived.UNSET
+        self.value: typing.Any = None
+
+    '''
+    Returns the cached value if the inputs are unchanged, otherwise computes and caches a new value
+    '''
+    def get(self, inputs: typing.Any, compute: typing.Callable[[], typing.Any]) -> typing.Any:
+        if self.inputs is Derived.UNSET or inputs != self.inputs:
+            self.value = compute()
+            self.inputs = inputs
+        return self.value
+
+    '''
+    Forces the value to be recomputed on the next get
+    '''
+    def invalidate(self):
+        self.inputs = Derived.UNSET
+
+
 SystemFunction = typing.Callable[['EntityGroup'], None]
+EntityCallback = typing.Callable[[Entity], None]
+
+'''
+A condition on a field of a singleton component, which is checked by the scheduler before running a system.
+Systems are skipped without being called unless all of their conditions pass. See: run_if, run_unless
+
+group.mount_system(effect_update_system, run_if('turn', 'state', TURN_EFFECTS))
+'''
+class RunCondition():
+    def __init__(self, component: str, field: str, values: tuple, expected: bool = True):
+        self.component = component
+        self.field = field
+        self.values = values
+        self.expected = expected
+
+    def test(self, group: 'EntityGroup') -> bool:
+        component = getattr(group.query_singleton(self.component), self.component)
+        return (getattr(component, self.field) in self.values) == self.expected
+
+'''
+Run the system only while the singleton component field has one of the given values
+'''
+def run_if(component: str, field: str, *values: typing.Any) -> RunCondition:
+    return RunCondition(component, field, values)
+
+'''
+Run the system only while the singleton component field has none of the given values
+'''
+def run_unless(component: str, field: str, *values: typing.Any) -> RunCondition:
+    return RunCondition(component, field, values, expected=False)
 
 class EntityGroup():
     def __init__(self):
-        self.entities: list[Entity] = []
-        self.systems: list[SystemFunction] = []
+        self.entities: list[Entity] = [] # Densely packed. Order is not preserved over removals.
+        self.systems: list[tuple[SystemFunction, tuple[RunCondition, ...]]] = []
+        self.profiler = None # Optional engine.profiler.SystemProfiler
+        self.query_count = 0
         self._singleton_cache: dict[int, Entity] = {}
+        self._mask_cache: dict[tuple[str], int] = {}
+        self._query_cache: dict[int, dict[Entity, None]] = {}
         self._add_entity_queue: list[Entity] = []
         self._remove_entity_queue: list[Entity] = []
+        self._slot_generations: list[int] = []
+        self._slot_indices: list[int] = [] # Slot -> index into self.entities
+        self._free_slots: list[int] = []
+        self._observers: list[tuple[int, EntityCallback | None, EntityCallback | None]] = []
 
     '''
     Add a new entity to the group. The components must already be assigned, as they are used for component masks.
+    The mask may be supplied if it is already known (see: Prefab), to save recomputing it.
     This is deferred till the start of the next frame.
     '''
-    def add(self, entity: Entity):
-        entity.mask = component_mask(vars(entity).keys())
+    def add(self, entity: Entity, mask: int | None = None):
+        entity.mask = component_mask(vars(entity).keys()) if mask is None else mask
         self._add_entity_queue.append(entity)
 
     '''
@@ -110,35 +234,107 @@ class EntityGroup():
         self._remove_entity_queue.append(entity)
 
     '''
-    Adds a new system
+    Returns the entity for a handle, or None if the handle is stale or belongs to another group
+    '''
+    def get(self, handle: int) -> Entity | None:
+        if handle < 0:
+            return None
+        slot = handle & HANDLE_SLOT_MASK
+        if slot >= len(self._slot_generations) or self._slot_generations[slot] != handle >> HANDLE_SLOT_BITS:
+            return None
+        index = self._slot_indices[slot]
+        if index >= len(self.entities):
+            return None
+        e = self.entities[index]
+        return e if e.handle == handle else None
+
+    '''
+    Returns true if the handle refers to an entity currently in the group
+    '''
+    def is_valid(self, handle: int) -> bool:
+        return self.get(handle) is not None
+
+    '''
+    Registers callbacks for when entities containing the required properties are added to or removed from the group.
+    These are called while the entity queues are flushed. Removed entities still hold their handle during on_remove.
+    Entities already in the group are passed to on_add immediately.
+    '''
+    def observe(self, on_add: EntityCallback | None, on_remove: EntityCallback | None, *components: str):
+        mask = self._query_mask(components)
+        self._observers.append((mask, on_add, on_remove))
+        if on_add:
+            for e in self.query(*components):
+                on_add(e)
+
+    '''
+    Adds a new system, optionally with conditions that must pass for it to be run
     '''
-    def mount_system(self, system: SystemFunction):
-        self.systems.append(system)
+    def mount_system(self, system: SystemFunction, *conditions: RunCondition):
+        self.systems.append((system, conditions))
 
     '''
-    Run all the mounted systems (in the order they were mounted)
+    Run all the mounted systems (in the order they were mounted), skipping any whose conditions fail
     '''
     def run_systems(self):
+        if self.profiler:
+            self._run_systems_profiled()
+            return
+        self._flush_entity_queues()
+        for system, conditions in self.systems:
+            for condition in conditions:
+                if not condition.test(self):
+                    break
+            else:
+                system(self)
+
+    '''
+    Run all the mounted systems, recording their timings in the profiler
+    '''
+    def _run_systems_profiled(self):
+        profiler = self.profiler
+        frame_start = time.perf_counter()
+        frame_queries = self.query_count
         self._flush_entity_queues()
-        for system in self.systems:
-            system(self)
+        for system, conditions in self.systems:
+            for condition in conditions:
+                if not condition.test(self):
+                    break
+            else:
+                queries = self.query_count
+                start = time.perf_counter()
+                system(self)
+                profiler.record_system(system.__name__, time.perf_counter() - start, self.query_count - queries)
+        profiler.record_frame(time.perf_counter() - frame_start, len(self.entities), self.query_count - frame_queries)
+
+    '''
+    Returns the component mask for a query, caching it against the component names.
+    '''
+    def _query_mask(self, components: tuple[str]) -> int:
+        mask = self._mask_cache.get(components)
+        if mask is None:
+            mask = self._mask_cache[components] = component_mask(components)
+        return mask
 
     '''
     Yields an iterable of entities which contain the required properties.
-    If this becomes too slow, we can just cache these.
+    The matching entities are cached per mask, and kept up to date as entities are added or removed.
     '''
-    def query(self, *components: str) -> typing.Generator[Entity, None, None]:
-        mask = component_mask(components)
-        for e in self.entities:
-            if e.mask & mask == mask:
-                yield e
+    def query(self, *components: str) -> typing.Iterator[Entity]:
+        self.query_count += 1
+        mask = self._query_mask(components)
+        matches = self._query_cache.get(mask)
+        if matches is None:
+            matches = {e: None for e in self.entities if e.mask & mask == mask}
+            self._query_cache[mask] = matches
+        return iter(matches)
 
     '''
     Returns the first entity that contains the require properties.
     This value gets cached, as singletons are not expected to be changed over the group lifetime.
     '''
     def query_singleton(self, *components: str) -> Entity:
-        mask = component_mask(components)
+        self.query_count += 1
+        mask = self._query_mask(components)
         if not mask in self._singleton_cache:
             try:
                 self._singleton_cache[mask] = next(self.query(*components))
@@ -152,15 +348,62 @@ class EntityGroup():
     def _flush_entity_queues(self):
 
         # Remove deleted entities
+        # The queues are swapped out first, so entities queued by observers are kept for the next flush
         if len(self._remove_entity_queue):
-            for e in self._remove_entity_queue:
-                try:
-                    self.entities.remove(e)
-                except ValueError:
+            queue, self._remove_entity_queue = self._remove_entity_queue, []
+            for e in queue:
+                if self.get(e.handle) is not e:
                     continue # An entity could be removed twice. Ignore it.
-            self._remove_entity_queue.clear()
+                for mask, _, on_remove in self._observers:
+                    if on_remove and e.mask & mask == mask:
+                        on_remove(e)
+                self._remove_entity(e)
+                for mask, matches in self._query_cache.items():
+                    if e.mask & mask == mask:
+                        matches.pop(e, None)
 
         # Add new entities
         if len(self._add_entity_queue):
-            self.entities.extend(self._add_entity_queue)
-            self._add_entity_queue.clear()
\ No newline at end of file
+            queue, self._add_entity_queue = self._add_entity_queue, []
+            added = [e for e in queue if self._add_entity(e)]
+            for mask, matches in self._query_cache.items():
+                for e in added:
+                    if e.mask & mask == mask:
+                        matches[e] = None
+            for mask, on_add, _ in self._observers:
+                if on_add:
+                    for e in added:
+                        if e.mask & mask == mask:
+                            on_add(e)
+
+    '''
+    Stores an entity in a free slot, and assigns its handle.
+    Returns false if the entity is already in the group.
+    '''
+    def _add_entity(self, e: Entity) -> bool:
+        if self.get(e.handle) is e:
+            return False
+        if len(self._free_slots):
+            slot = self._free_slots.pop()
+        else:
+            slot = len(self._slot_generations)
+            self._slot_generations.append(0)
+            self._slot_indices.append(0)
+        self._slot_indices[slot] = len(self.entities)
+        self.entities.append(e)
+        e.handle = (self._slot_generations[slot] << HANDLE_SLOT_BITS) | slot
+        return True
+
+    '''
+    Swap-removes an entity from the dense list, and frees its slot.
+    '''
+    def _remove_entity(self, e: Entity):
+        slot = e.handle & HANDLE_SLOT_MASK
+        index = self._slot_indices[slot]
+        last = self.entities.pop()
+        if last is not e:
+            self.entities[index] = last
+            self._slot_indices[last.handle & HANDLE_SLOT_MASK] = index
+        self._slot_generations[slot] += 1
+        self._free_slots.append(slot)
+        e.handle = NULL_HANDLE
\ No newline at end of file
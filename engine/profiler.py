@@ -0,0 +1,100 @@
+import atexit
+import collections
+import csv
+import json
+import math
+
+'''
+Returns the value at the given percentile (0-100) of some samples, using the nearest rank
+'''
+def percentile(samples: list[float], p: float) -> float:
+    if not len(samples):
+        return 0.0
+    ordered = sorted(samples)
+    rank = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+'''
+Returns the p50/p95/max/mean of some samples
+'''
+def summarize(samples: collections.deque) -> dict[str, float]:
+    samples = list(samples)
+    return {
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'max': max(samples, default=0.0),
+        'mean': sum(samples) / len(samples) if len(samples) else 0.0,
+        'samples': len(samples),
+    }
+
+
+'''
+Per-system frame profiler. See: EntityGroup.run_systems
+Keeps a rolling window of wall times (in milliseconds) and query counts for each system,
+and of the frame time, entity count and query count for each frame.
+
+If an output path is given, the summary is written there on exit (as CSV if the path ends in .csv, otherwise JSON).
+'''
+class SystemProfiler():
+    def __init__(self, output: str | None = None, window: int = 600):
+        self.window = window
+        self.frames = 0
+        self.system_times: dict[str, collections.deque] = {}
+        self.system_queries: dict[str, collections.deque] = {}
+        self.frame_times = collections.deque(maxlen=window)
+        self.entity_counts = collections.deque(maxlen=window)
+        self.query_counts = collections.deque(maxlen=window)
+        if output:
+            atexit.register(self.dump, output)
+
+    '''
+    Records a single system run
+    '''
+    def record_system(self, name: str, seconds: float, queries: int):
+        if name not in self.system_times:
+            self.system_times[name] = collections.deque(maxlen=self.window)
+            self.system_queries[name] = collections.deque(maxlen=self.window)
+        self.system_times[name].append(seconds * 1000)
+        self.system_queries[name].append(queries)
+
+    '''
+    Records the totals for a frame
+    '''
+    def record_frame(self, seconds: float, entities: int, queries: int):
+        self.frames += 1
+        self.frame_times.append(seconds * 1000)
+        self.entity_counts.append(entities)
+        self.query_counts.append(queries)
+
+    '''
+    Returns the rolling statistics, keyed by system name (and "frame" for the frame totals)
+    '''
+    def summary(self) -> dict[str, dict[str, dict[str, float]]]:
+        summary = {
+            'frame': {
+                'time_ms': summarize(self.frame_times),
+                'entities': summarize(self.entity_counts),
+                'queries': summarize(self.query_counts),
+            }
+        }
+        for name, times in self.system_times.items():
+            summary[name] = {
+                'time_ms': summarize(times),
+                'queries': summarize(self.system_queries[name]),
+            }
+        return summary
+
+    '''
+    Writes the summary to a file, as CSV if the path ends in .csv, otherwise as JSON
+    '''
+    def dump(self, path: str):
+        summary = self.summary()
+        with open(path, 'w', newline='') as f:
+            if not path.endswith('.csv'):
+                json.dump({'frames': self.frames, 'window': self.window, 'stats': summary}, f, indent=2)
+                return
+            writer = csv.writer(f)
+            writer.writerow(['name', 'metric', 'p50', 'p95', 'max', 'mean', 'samples'])
+            for name, metrics in summary.items():
+                for metric, stats in metrics.items():
+                    writer.writerow([name, metric, stats['p50'], stats['p95'], stats['max'], stats['mean'], stats['samples']])
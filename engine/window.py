@@ -11,6 +11,7 @@ class Window():
         self.surface.fill((0,0,0))
         self.clock = pygame.time.Clock()
         self.frame_rate = 60
+        self.idle_frame_rate = 10 # Used when nothing has changed, see: update
         self.exited = False
 
     '''
@@ -24,11 +25,27 @@ class Window():
     '''
     Update the display (assuming the render surface has been modified).
     Also introduces a delay to maintain the desired frame rate.
+
+    If the frame was not redrawn, the display is left showing the previous frame.
+    When idle, the delay is stretched to the idle frame rate, but any input event ends it early.
+    Only idle while the game is waiting on input, as anything still running would be slowed to the idle frame rate.
+    If rects are given, only those areas are updated, and the surface is not cleared (the renderer clears what it redraws).
     '''
-    def update(self):
-        pygame.display.flip()
-        self.clock.tick(self.frame_rate)
-        self.surface.fill((0,0,0))
+    def update(self, redraw: bool = True, idle: bool = False, rects: list[pygame.Rect] | None = None):
+        if redraw and rects is not None:
+            pygame.display.update(rects)
+            self.clock.tick(self.frame_rate)
+        elif redraw:
+            pygame.display.flip()
+            self.clock.tick(self.frame_rate)
+            self.surface.fill((0,0,0))
+        elif idle:
+            event = pygame.event.wait(1000 // self.idle_frame_rate)
+            if event.type != pygame.NOEVENT:
+                pygame.event.post(event) # Leave it for handle_events
+            self.clock.tick()
+        else:
+            self.clock.tick(self.frame_rate)
 
     def close(self):
         pygame.quit()
@@ -1,6 +1,9 @@
+import os
+
 from init import init
 from engine.window import Window
 from engine.ecs import EntityGroup
+from engine.profiler import SystemProfiler
 
 import systems
 
@@ -8,6 +11,10 @@ import systems
 window = Window()
 group = EntityGroup()
 
+# Optional per-system profiling, written out on exit. eg: PROFILE_SYSTEMS=profile.csv
+if os.environ.get('PROFILE_SYSTEMS'):
+    group.profiler = SystemProfiler(os.environ['PROFILE_SYSTEMS'])
+
 # Load systems onto the group
 # Note, systems will be run in the order they are mounted
 systems.time.mount_time_system(group, window.clock)
@@ -20,7 +27,7 @@ systems.enemy.mount_enemy_system(group)
 systems.effect.mount_effect_system(group)
 systems.motion.mount_motion_system(group)
 systems.health.mount_health_system(group)
-systems.sprites.mount_sprite_system(group, window.surface)
+systems.sprites.mount_sprite_system(group, window.surface, render_on_change=True, dirty_rects=True)
 systems.spell.mount_spell_system(group)
 systems.ui.mount_ui_system(group)
 
@@ -31,6 +38,8 @@ init(group, window)
 while not window.exited:
     window.handle_events()
     group.run_systems()
-    window.update()
+    camera = group.query_singleton('camera').camera
+    turn = group.query_singleton('turn').turn
+    window.update(camera.redraw, idle=camera.is_idle(turn), rects=camera.updated_rects())
 
 window.close()
@@ -3,59 +3,92 @@ import typing
 
 from pygame import Vector2
 
-from .motion import MotionComponent
 from . import motion
 
 
 '''
-A component that does collision detection
+Returns the grid cell containing a position, for use as a key in the collision layers
+'''
+def cell_key(pos: Vector2) -> tuple[int, int]:
+    return (int(pos[0]), int(pos[1]))
+
+
+'''
+A component that does collision detection.
+Each layer is a spatial hash mapping grid cells to the entities in them, so point lookups are O(1).
+The index is maintained incrementally: entities are inserted and removed as they join or leave the group,
+and moved by the motion system when their position changes. See: mount_collision_system
 '''
 @enumerate_component("collision")
 class CollisionComponent():
-    lookup = {}
-    layers: list[list[Entity]] = factory(list)
+    layers: list[dict[tuple[int, int], list[Entity]]] = factory(list)
+    indexed: dict[Entity, tuple[int, tuple[int, int]]] = factory(dict) # The layer and cell each entity is stored under
 
-    def get_entities_at(self, pos: Vector2, layer: int) -> typing.Generator[Entity,None,None]:
-        for e in self.layers[layer]:
-            if e.motion.position == pos:
-                yield e
+    def get_entities_at(self, pos: Vector2, layer: int) -> typing.Iterable[Entity]:
+        return self.layers[layer].get(cell_key(pos), ())
 
     def is_occupied(self, pos: Vector2, layer: int) -> bool:
-        for e in self.layers[layer]:
-            if e.motion.position == pos:
-                return True
-        return False
+        return cell_key(pos) in self.layers[layer]
+
+    '''
+    Adds an entity to the index. Entities without a layer are ignored.
+    '''
+    def insert(self, e: Entity):
+        layer = e.motion.layer
+        if layer == None or e in self.indexed:
+            return
+        key = cell_key(e.motion.position)
+        self.indexed[e] = (layer, key)
+        self._add_to_cell(e, layer, key)
+
+    '''
+    Removes an entity from the index
+    '''
+    def remove(self, e: Entity):
+        entry = self.indexed.pop(e, None)
+        if entry != None:
+            self._remove_from_cell(e, *entry)
+
+    '''
+    Updates the cell of an indexed entity after its position has changed
+    '''
+    def move(self, e: Entity):
+        entry = self.indexed.get(e)
+        if entry == None:
+            return
+        layer, key = entry
+        new_key = cell_key(e.motion.position)
+        if new_key != key:
+            self._remove_from_cell(e, layer, key)
+            self._add_to_cell(e, layer, new_key)
+            self.indexed[e] = (layer, new_key)
+
+    def _add_to_cell(self, e: Entity, layer: int, key: tuple[int, int]):
+        cells = self.layers[layer]
+        if key in cells:
+            cells[key].append(e)
+        else:
+            cells[key] = [e]
+
+    def _remove_from_cell(self, e: Entity, layer: int, key: tuple[int, int]):
+        cells = self.layers[layer]
+        entities = cells[key]
+        entities.remove(e)
+        if not len(entities):
+            del cells[key]
         
     @staticmethod
     def from_layer_count(layers: int) -> 'CollisionComponent':
-        return CollisionComponent(layers=[ [] for _ in range(layers) ])
-
+        return CollisionComponent(layers=[ {} for _ in range(layers) ])
 
 
 '''
-The sprite drawings system:
-Use the camera position to draw all entities with a sprite at their relative location.
-'''
-def collision_system(group: EntityGroup):
-
-    collisions: CollisionComponent = group.query_singleton("collision").collision
-
-    for layer in collisions.layers:
-        layer.clear()
-
-    for e in group.query("motion"):
-        motion: MotionComponent = e.motion
-        if motion.layer != None:
-            collisions.layers[motion.layer].append(e)
-
-
-'''
-Mounts the sprite drawing system, and adds a camera component for the viewport
+Adds a collision component, and keeps it updated as entities with motion are added to or removed from the group.
+Position changes are reported by the motion system.
 '''
 def mount_collision_system(group: EntityGroup):
     e = Entity("collision")
     e.collision = CollisionComponent.from_layer_count(motion.LAYER_COUNT)
     group.add(e)
 
-    group.mount_system(collision_system)
-
+    group.observe(e.collision.insert, e.collision.remove, 'motion')
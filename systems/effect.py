@@ -1,13 +1,16 @@
-from engine.ecs import Entity, EntityGroup, enumerate_component, factory
-from pygame import Vector2
+from engine.ecs import Entity, EntityGroup, Prefab, enumerate_component, factory, run_if
+from pygame import Rect, Vector2
 from dataclasses import dataclass
 import random
 import math
+import typing
 
-from .sprites import SpriteComponent
+import numpy as np
+
+from .sprites import SpriteBatchComponent, SpriteComponent
 from .motion import MotionComponent
 from .tilemap import TilemapComponent
-from .collision import CollisionComponent
+from .collision import CollisionComponent, cell_key
 from .health import HealthComponent
 from . import turn
 from . import tilemap
@@ -21,42 +24,78 @@ SHAPE_FILL = 2
 SHAPE_LANCE = 3
 
 
+NO_TILE = 255 # Used for positions outside the map bounds, which no rule applies to
+
 '''
-Component class to store effect information
+The rules of an effect type, compiled into arrays indexed by tile id.
+Rules are built up while creating the templates, then frozen so the arrays are read only.
+All effects of a type share the rules of their template, so they are never copied per effect.
 '''
-@enumerate_component("effect")
-class EffectComponent():
-    name: str
-    direction: Vector2 = factory(Vector2)
-    energy: int = 1
-    shape: int = SHAPE_NONE
-    harvests: dict[int,tuple[int,int]] = factory(dict)
-    chains_to: dict[int,tuple[float,int]] = factory(dict)
-    cast_from: list[int]
-    propagates_to: list[int] = factory(list)
-    damage: int = 0
-    consumes: list[str] = factory(list)
+class EffectRules():
+    def __init__(self, cast_from: list[int], damage: int = 0):
+        self.cast_from = tuple(cast_from)
+        self.damage = damage
+        self.consumes: set[str] | frozenset[str] = set()
+        self.harvests = np.zeros(256, dtype=bool)
+        self.next_tile = np.arange(256, dtype=np.uint8)
+        self.energy_gain = np.zeros(256, dtype=np.int64)
+        self.propagates = np.zeros(256, dtype=bool)
+        self.chains = np.zeros(256, dtype=bool)
+        self.chain_probability = np.zeros(256)
+        self.chain_energy = np.zeros(256, dtype=np.int64)
 
     def add_harvest(self, tile_in: int, tile_out: int, energy: int, propagates: bool = False):
-        self.harvests[tile_in] = (tile_out, energy)
+        self.harvests[tile_in] = True
+        self.next_tile[tile_in] = tile_out
+        self.energy_gain[tile_in] = energy
         if propagates:
-            self.propagates_to.append(tile_in)
+            self.propagates[tile_in] = True
 
     def add_chain(self, tile_in: int, probability: float = 1.0, energy: int = 0):
-        self.chains_to[tile_in] = (probability, energy)
+        self.chains[tile_in] = True
+        self.chain_probability[tile_in] = probability
+        self.chain_energy[tile_in] = energy
 
     def add_consumes(self, name: str):
-        self.consumes.append(name)
+        self.consumes.add(name)
+
+    '''
+    Makes the rules read only
+    '''
+    def freeze(self):
+        self.consumes = frozenset(self.consumes)
+        for array in (self.harvests, self.next_tile, self.energy_gain, self.propagates, self.chains, self.chain_probability, self.chain_energy):
+            array.flags.writeable = False
+
+
+'''
+Component class to store effect information.
+The rules are shared with the template the effect was created from. See: EffectRules
+'''
+@enumerate_component("effect")
+class EffectComponent():
+    name: str
+    rules: EffectRules
+    direction: Vector2 = factory(Vector2)
+    energy: int = 1
+    shape: int = SHAPE_NONE
 
     def requires_direction(self):
         return self.shape != SHAPE_NONE
 
 
 '''
-Enumerates through the valid targets for a given effect
+Returns the id of the tile at a position, or NO_TILE if it is outside the map
 '''
-def valid_tiles(map: TilemapComponent, valid: list[int], coords: list[Vector2]):
-    return [ coord for coord in coords if (map.get_tile(coord) in valid) ]
+def tile_at(map: TilemapComponent, coord: Vector2) -> int:
+    tile = map.get_tile(coord)
+    return NO_TILE if tile is None else tile
+
+'''
+Enumerates through the valid targets for a given effect, given a rule array of the valid tiles
+'''
+def valid_tiles(map: TilemapComponent, valid: np.ndarray, coords: list[Vector2]):
+    return [ coord for coord in coords if valid.item(tile_at(map, coord)) ]
 
 '''
 Shuffles the list.
@@ -69,11 +108,11 @@ def shuffled(items: list) -> list:
 
 
 def try_harvest(map: TilemapComponent, pos: Vector2, effect: EffectComponent):
-    tile = map.get_tile(pos)
-    if tile in effect.harvests:
-        new_tile, energy_gain = effect.harvests[tile]
-        map.set_tile(pos, new_tile)
-        effect.energy += energy_gain
+    tile = tile_at(map, pos)
+    rules = effect.rules
+    if rules.harvests.item(tile):
+        map.set_tile(pos, rules.next_tile.item(tile))
+        effect.energy += rules.energy_gain.item(tile)
 
 
 def apply_damage(collision: CollisionComponent, pos: Vector2, damage: int):
@@ -85,122 +124,188 @@ def apply_damage(collision: CollisionComponent, pos: Vector2, damage: int):
         health: HealthComponent = e.health
         health.health -= damage
 
+'''
+Returns the places an effect would like to propagate to this turn, as (position, energy, shape), in the order they are resolved.
+'''
+def propagation_requests(map: TilemapComponent, effect: EffectComponent, pos: Vector2) -> list[tuple[Vector2, int, int]]:
+    rules = effect.rules
+    dir = effect.direction
+    propagation_request: list[tuple[Vector2, int, int]] = []
+    unchecked_coords = []
+
+    # Do the forced propagation, which is shape specific
+    if effect.shape == SHAPE_WAVE:
+        # Waves transfer all energy forward.
+        propagation_request = [
+            (pos + dir, effect.energy - 1, SHAPE_WAVE),
+        ]
+
+        # Waves start waves in valid adjacent tiles
+        for coord in valid_tiles(map, rules.propagates, utils.vector_normals(pos, dir)):
+            propagation_request.append( (coord, 0, SHAPE_WAVE) )
+        unchecked_coords = [-dir]
+
+    elif effect.shape == SHAPE_FILL:
+        # Goes out in all directions
+        valid_coords = valid_tiles(map, rules.propagates, shuffled(utils.vector_cardinals(pos)))
+        # Let the propagation step figure out if we use more energy than we have...
+        if len(valid_coords):
+            energy_transfer =  math.ceil(effect.energy) / len(valid_coords)
+            for coord in valid_coords:
+                propagation_request.append( (coord, energy_transfer, SHAPE_FILL) )
+
+    elif effect.shape == SHAPE_LANCE:
+        # Goes forward only
+        propagation_request = [
+            (pos + dir, effect.energy - 1, SHAPE_LANCE),
+        ]
+        unchecked_coords = list(utils.vector_normals(pos, dir)) + [-dir]
+
+    else: # SHAPE_NONE
+        unchecked_coords = utils.vector_cardinals(pos)
+
+    # Do the random propagation in the unchecked directions
+    for coord in shuffled( valid_tiles(map, rules.chains, unchecked_coords) ):
+        tile = tile_at(map, coord)
+        if random.random() < rules.chain_probability.item(tile):
+            propagation_request.append( (coord, rules.chain_energy.item(tile), SHAPE_NONE) )
+
+    return propagation_request
+
+
+'''
+A new effect on the propagation frontier, merged from every request of one effect type into one cell.
+Energies add, and the direction and shape are taken from the effect that made the largest transfer.
+'''
+@dataclass
+class FrontierCell():
+    position: Vector2
+    source: Entity
+    shape: int
+    largest: float
+    energy: float = 0
+    count: int = 0
+
+    def merge(self, source: Entity, energy: float, shape: int):
+        if energy > self.largest:
+            self.source, self.shape, self.largest = source, shape, energy
+        self.energy += energy
+        self.count += 1
+
+
+'''
+Resolves the propagation requests of every effect for the turn in one pass, and returns the frontier of new effects.
+Requests are blocked by any effect already in the target cell, unless the requesting effect consumes it. Consumed effects are removed,
+and their own requests are dropped, as if they had been consumed before they could propagate.
+Each remaining effect then transfers energy to its unblocked requests in order, without going below 1 energy.
+'''
+def resolve_propagation(group: EntityGroup, collision: CollisionComponent, requests: list[tuple[Entity, list[tuple[Vector2, int, int]]]]) -> dict[tuple[tuple[int, int], str], FrontierCell]:
+    occupants: dict[tuple[int, int], typing.Iterable[Entity]] = {}
+    consumed: dict[Entity, None] = {}
+    unblocked: list[tuple[Entity, list[tuple[Vector2, int, int]]]] = []
+
+    for e, propagation_request in requests:
+        consumes = e.effect.rules.consumes
+        allowed = []
+        for coord, energy, shape in propagation_request:
+            cell = cell_key(coord)
+            if cell not in occupants:
+                occupants[cell] = collision.get_entities_at(coord, e.motion.layer)
+
+            blocked = False
+            for other in occupants[cell]:
+                if other.effect.name in consumes:
+                    consumed[other] = None
+                else:
+                    blocked = True
+
+            if not blocked:
+                allowed.append((coord, energy, shape))
+        unblocked.append((e, allowed))
+
+    for other in consumed:
+        other.effect.energy = 0
+        group.remove(other)
+
+    frontier: dict[tuple[tuple[int, int], str], FrontierCell] = {}
+    for e, allowed in unblocked:
+        if e in consumed:
+            continue
+        effect: EffectComponent = e.effect
+        for coord, energy, shape in allowed:
+            energy = min(energy, max(0, effect.energy - 1))
+            effect.energy -= energy
+            key = (cell_key(coord), effect.name)
+            if key not in frontier:
+                frontier[key] = FrontierCell(position=coord, source=e, shape=shape, largest=energy)
+            frontier[key].merge(e, energy, shape)
+
+    return frontier
+
+
 '''
 The effect update system:
 Handles effect propigation and decay (probably)
+Every effect harvests and makes its propagation requests, then the requests are resolved together. See: resolve_propagation
+The new effects are only spawned after that, so they all see the map and the effects as they were at the start of the turn.
+Only run during the effects turn.
 '''
 def effect_update_system(group: EntityGroup):
 
-    t: turn.TurnComponent = group.query_singleton("turn").turn
-
-    if t.state != turn.TURN_EFFECTS:
-        return
-    
     map: TilemapComponent = group.query_singleton('tilemap').tilemap
     collision: CollisionComponent = group.query_singleton('collision').collision
 
+    requests: list[tuple[Entity, list[tuple[Vector2, int, int]]]] = []
     for e in group.query("effect", "motion"):
         
         effect: EffectComponent = e.effect
-        motion: MotionComponent = e.motion
-        pos = motion.position
-        dir = effect.direction
+        pos = e.motion.position
 
         # Harvesting
         try_harvest(map, pos, effect)
         
         # Propagation
         if effect.energy > 1:
+            apply_damage(collision, pos, effect.rules.damage)
+            requests.append((e, propagation_requests(map, effect, pos)))
+
+    frontier = resolve_propagation(group, collision, requests)
 
-            apply_damage(collision, pos, effect.damage)
-
-            # A list of places we would like to try propagate to.
-            # (position, energy, shape)
-            propagation_request: list[tuple[Vector2, int, int]] = []
-            unchecked_coords = []
-
-            # Do the forced propagation, which is shape specific
-            if effect.shape == SHAPE_WAVE:
-                # Waves transfer all energy forward.
-                propagation_request = [
-                    (pos + dir, effect.energy - 1, SHAPE_WAVE),
-                ]
-
-                # Waves start waves in valid adjacent tiles
-                for coord in valid_tiles(map, effect.propagates_to, utils.vector_normals(pos, dir)):
-                    propagation_request.append( (coord, 0, SHAPE_WAVE) )
-                unchecked_coords = [-dir]
-
-            elif effect.shape == SHAPE_FILL:
-                # Goes out in all directions
-                valid_coords = valid_tiles(map, effect.propagates_to, shuffled(utils.vector_cardinals(pos)))
-                # Let the propagation step figure out if we use more energy than we have...
-                if len(valid_coords):
-                    energy_transfer =  math.ceil(effect.energy) / len(valid_coords)
-                    for coord in valid_coords:
-                        propagation_request.append( (coord, energy_transfer, SHAPE_FILL) )
-
-            elif effect.shape == SHAPE_LANCE:
-                # Goes forward only
-                propagation_request = [
-                    (pos + dir, effect.energy - 1, SHAPE_LANCE),
-                ]
-                unchecked_coords = list(utils.vector_normals(pos, dir)) + [-dir]
-
-            else: # SHAPE_NONE
-                unchecked_coords = utils.vector_cardinals(pos)
-
-            # Do the random propagation in the unchecked directions
-            for coord in shuffled( valid_tiles(map, effect.chains_to, unchecked_coords) ):
-                probability, energy = effect.chains_to[map.get_tile(coord)]
-                if random.random() < probability:
-                    propagation_request.append( (coord, energy, SHAPE_NONE) )
-            
-            # Apply the propagation requests
-            for coord, energy, shape in propagation_request:
-                
-                blocked = False
-                for other in collision.get_entities_at(coord, e.motion.layer):
-                    if other.effect.name in effect.consumes:
-                        other.effect.energy = 0
-                        group.remove(other)
-                    else:
-                        blocked = True
-
-                if not blocked:
-                    energy = min(energy, max(0, effect.energy -1))
-                    new_entity = propagate_entity(e, coord, energy, shape)
-                    try_harvest(map, coord, new_entity.effect)
-                    apply_damage(collision, coord, effect.damage)
-                    group.add(new_entity)
-
-        # decay
+    # decay
+    for e in group.query("effect", "motion"):
+        effect: EffectComponent = e.effect
         effect.energy -= 1
         if effect.energy <= 0:
             group.remove(e)
 
+    for cell in frontier.values():
+        new_entity = propagate_entity(cell.source, cell.position, cell.energy, cell.shape)
+        try_harvest(map, cell.position, new_entity.effect)
+        apply_damage(collision, cell.position, new_entity.effect.rules.damage * cell.count)
+        group.add(new_entity, new_entity.mask) # Mask is precomputed by the prefab
+
 
 '''
 Propagates an existing effect, inheriting some energy. Shape may be overridden here.
+The energy must already have been taken from the existing effect. See: resolve_propagation
 '''
 def propagate_entity(e: Entity, position: Vector2, energy: int, shape: int | None = None) -> Entity:
-    # Remove the energy from the previous effect
-    e.effect.energy -= energy
-
-    # Create the new effect
-    e = e.clone()
-    e.motion.position = position
-    e.effect.energy = energy
+    # Create the new effect from the template, carrying over the direction and shape
+    new = EFFECT_PREFABS[e.effect.name].instantiate()
+    new.motion.position = position
+    new.effect.direction = e.effect.direction
+    new.effect.energy = energy
+    new.effect.shape = e.effect.shape
 
     # The shape may be overridden
     if shape != None:
-        e.effect.shape = shape
+        new.effect.shape = shape
 
-    return e
+    return new
 
 
 '''
-Instantiate all the template effects. These can be cloned when required
+Instantiate all the template effects. These are wrapped in prefabs for instantiation
 '''
 def create_effect_templates():
     effect_dict = {}
@@ -208,85 +313,399 @@ def create_effect_templates():
     e = Entity("effect-fire")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (255,0,0))
-    e.effect = EffectComponent(name="fire", cast_from=[tilemap.TILE_PLANT], shape=SHAPE_WAVE, damage=200)
-    e.effect.add_harvest(tilemap.TILE_PLANT, tilemap.TILE_EMBER, 3, True)
-    e.effect.add_harvest(tilemap.TILE_WATER, tilemap.TILE_MUD, -3)
-    e.effect.add_harvest(tilemap.TILE_MUD, tilemap.TILE_EARTH, -1)
-    e.effect.add_chain(tilemap.TILE_PLANT, 0.5)
-    e.effect.add_consumes("growth")
+    e.effect = EffectComponent(name="fire", shape=SHAPE_WAVE, rules=EffectRules(cast_from=[tilemap.TILE_PLANT], damage=200))
+    e.effect.rules.add_harvest(tilemap.TILE_PLANT, tilemap.TILE_EMBER, 3, True)
+    e.effect.rules.add_harvest(tilemap.TILE_WATER, tilemap.TILE_MUD, -3)
+    e.effect.rules.add_harvest(tilemap.TILE_MUD, tilemap.TILE_EARTH, -1)
+    e.effect.rules.add_chain(tilemap.TILE_PLANT, 0.5)
+    e.effect.rules.add_consumes("growth")
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-wave")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (0,0,255))
-    e.effect = EffectComponent(name="wave", cast_from=[tilemap.TILE_WATER],shape=SHAPE_WAVE, damage=100)
-    e.effect.add_harvest(tilemap.TILE_WATER, tilemap.TILE_MUD, 3, True)
-    e.effect.add_harvest(tilemap.TILE_EARTH, tilemap.TILE_MUD, 0)
+    e.effect = EffectComponent(name="wave", shape=SHAPE_WAVE, rules=EffectRules(cast_from=[tilemap.TILE_WATER], damage=100))
+    e.effect.rules.add_harvest(tilemap.TILE_WATER, tilemap.TILE_MUD, 3, True)
+    e.effect.rules.add_harvest(tilemap.TILE_EARTH, tilemap.TILE_MUD, 0)
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-growth")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (0,255,0))
-    e.effect = EffectComponent(name="growth",cast_from=[tilemap.TILE_MUD], damage=25)
-    e.effect.add_harvest(tilemap.TILE_MUD, tilemap.TILE_PLANT, 10, True)
-    e.effect.add_harvest(tilemap.TILE_EARTH, tilemap.TILE_PLANT, 0)
-    e.effect.add_chain(tilemap.TILE_MUD, 0.25)
-    e.effect.add_chain(tilemap.TILE_EARTH, 0.25)
+    e.effect = EffectComponent(name="growth", rules=EffectRules(cast_from=[tilemap.TILE_MUD], damage=25))
+    e.effect.rules.add_harvest(tilemap.TILE_MUD, tilemap.TILE_PLANT, 10, True)
+    e.effect.rules.add_harvest(tilemap.TILE_EARTH, tilemap.TILE_PLANT, 0)
+    e.effect.rules.add_chain(tilemap.TILE_MUD, 0.25)
+    e.effect.rules.add_chain(tilemap.TILE_EARTH, 0.25)
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-spark")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (255,255,0))
-    e.effect = EffectComponent(name="spark",cast_from=[tilemap.TILE_EMBER], shape=SHAPE_LANCE, damage=300)
-    e.effect.add_harvest(tilemap.TILE_EMBER, tilemap.TILE_EARTH, 2, True)
+    e.effect = EffectComponent(name="spark", shape=SHAPE_LANCE, rules=EffectRules(cast_from=[tilemap.TILE_EMBER], damage=300))
+    e.effect.rules.add_harvest(tilemap.TILE_EMBER, tilemap.TILE_EARTH, 2, True)
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-ice")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (127,127,255))
-    e.effect = EffectComponent(name="ice", cast_from=[tilemap.TILE_WATER], shape=SHAPE_LANCE, damage=100)
-    e.effect.add_harvest(tilemap.TILE_WATER, tilemap.TILE_ICE, 2, True)
+    e.effect = EffectComponent(name="ice", shape=SHAPE_LANCE, rules=EffectRules(cast_from=[tilemap.TILE_WATER], damage=100))
+    e.effect.rules.add_harvest(tilemap.TILE_WATER, tilemap.TILE_ICE, 2, True)
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-corrupt")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (127,0,127))
-    e.effect = EffectComponent(name="corrupt", cast_from=[tilemap.TILE_BONES], shape=SHAPE_FILL, damage=25)
-    e.effect.add_harvest(tilemap.TILE_ICE, tilemap.TILE_OOZE, 2, True)
-    e.effect.add_harvest(tilemap.TILE_MUD, tilemap.TILE_MARSH, 2, True)
-    e.effect.add_harvest(tilemap.TILE_EMBER, tilemap.TILE_ASH, 2, True)
-    e.effect.add_harvest(tilemap.TILE_LAVA, tilemap.TILE_HELLSCAPE, 2, True)
-    e.effect.add_harvest(tilemap.TILE_BONES, tilemap.TILE_EARTH, 4, True)
+    e.effect = EffectComponent(name="corrupt", shape=SHAPE_FILL, rules=EffectRules(cast_from=[tilemap.TILE_BONES], damage=25))
+    e.effect.rules.add_harvest(tilemap.TILE_ICE, tilemap.TILE_OOZE, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_MUD, tilemap.TILE_MARSH, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_EMBER, tilemap.TILE_ASH, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_LAVA, tilemap.TILE_HELLSCAPE, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_BONES, tilemap.TILE_EARTH, 4, True)
     effect_dict[e.effect.name] = e
 
     e = Entity("effect-purify")
     e.motion = MotionComponent(layer=motion.LAYER_EFFECTS)
     e.sprite = SpriteComponent.from_circle(16, (255,255,200))
-    e.effect = EffectComponent(name="purify", cast_from=[tilemap.TILE_BONES], shape=SHAPE_FILL, damage=0)
-    e.effect.add_harvest(tilemap.TILE_OOZE, tilemap.TILE_ICE, 2, True)
-    e.effect.add_harvest(tilemap.TILE_MARSH, tilemap.TILE_MUD, 2, True)
-    e.effect.add_harvest(tilemap.TILE_ASH, tilemap.TILE_EMBER, 2, True)
-    e.effect.add_harvest(tilemap.TILE_HELLSCAPE, tilemap.TILE_LAVA, 2, True)
-    e.effect.add_harvest(tilemap.TILE_BONES, tilemap.TILE_EARTH, 4, True)
+    e.effect = EffectComponent(name="purify", shape=SHAPE_FILL, rules=EffectRules(cast_from=[tilemap.TILE_BONES], damage=0))
+    e.effect.rules.add_harvest(tilemap.TILE_OOZE, tilemap.TILE_ICE, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_MARSH, tilemap.TILE_MUD, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_ASH, tilemap.TILE_EMBER, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_HELLSCAPE, tilemap.TILE_LAVA, 2, True)
+    e.effect.rules.add_harvest(tilemap.TILE_BONES, tilemap.TILE_EARTH, 4, True)
     effect_dict[e.effect.name] = e
-    
+
+    for e in effect_dict.values():
+        e.effect.rules.freeze()
     return effect_dict
 
 EFFECT_TEMPLATES = create_effect_templates()
+EFFECT_PREFABS = { name: Prefab(template) for name, template in EFFECT_TEMPLATES.items() }
 
 
 '''
 Spawns a new effect (as per a spell)
 '''
 def create_effect(type: str, position: Vector2, direction: Vector2 = Vector2(0)) -> Entity:
-    e = EFFECT_TEMPLATES[type].clone()
+    e = EFFECT_PREFABS[type].instantiate()
     e.motion.position = Vector2(position)
     e.effect.direction = direction
     return e
 
 
+GRID_DIRECTIONS = np.array([(1, 0), (0, 1), (-1, 0), (0, -1), (0, 0)]) # The cardinals (as per utils.vector_cardinals), then none
+GRID_NO_DIRECTION = 4
+
+'''
+Returns the index of a direction in GRID_DIRECTIONS
+'''
+def grid_direction(direction: Vector2) -> int:
+    for index, offset in enumerate(GRID_DIRECTIONS.tolist()):
+        if direction == offset:
+            return index
+    return GRID_NO_DIRECTION
+
+
+'''
+The rules of all the effect templates, stacked into tables indexed by [effect type, tile] for the grid engine.
+'''
+class EffectGridRules():
+    def __init__(self, templates: dict[str, Entity]):
+        self.names = list(templates)
+        rules: list[EffectRules] = [ template.effect.rules for template in templates.values() ]
+        self.harvests = np.stack([ r.harvests for r in rules ])
+        self.next_tile = np.stack([ r.next_tile for r in rules ])
+        self.energy_gain = np.stack([ r.energy_gain for r in rules ])
+        self.propagates = np.stack([ r.propagates for r in rules ])
+        self.chains = np.stack([ r.chains for r in rules ])
+        self.chain_probability = np.stack([ r.chain_probability for r in rules ])
+        self.chain_energy = np.stack([ r.chain_energy for r in rules ])
+        self.consumes = np.array([ [ name in r.consumes for name in self.names ] for r in rules ]) # [consumer, consumed]
+        self.damage = np.array([ r.damage for r in rules ], dtype=np.int64)
+
+
+'''
+Component for the grid effect engine. Rather than an entity each, effects are cells in grids covering the whole map,
+with one grid per effect type. The grids are advanced a whole turn at a time with array operations. See: EffectGridComponent.step
+
+Each effect type is drawn by one sprite batch entity, listed in batches in the same order as the rule names.
+'''
+@enumerate_component("effect_grid")
+class EffectGridComponent():
+    rules: EffectGridRules
+    alive: np.ndarray = None # (types, height, width) bool
+    energy: np.ndarray = None # (types, height, width) float
+    direction: np.ndarray = None # (types, height, width) index into GRID_DIRECTIONS
+    shape: np.ndarray = None # (types, height, width)
+    rng: np.random.Generator = factory(lambda: np.random.default_rng(random.getrandbits(64)))
+    batches: list[Entity] = factory(list)
+    batches_stale: bool = False # The grids have changed since the batches were updated
+
+    '''
+    Allocates the grids for a map size. Any effects are discarded if the size changes.
+    '''
+    def resize(self, size: tuple[int, int]):
+        size = (len(self.rules.names), *size)
+        if self.alive is not None and self.alive.shape == size:
+            return
+        self.alive = np.zeros(size, dtype=bool)
+        self.energy = np.zeros(size)
+        self.direction = np.full(size, GRID_NO_DIRECTION, dtype=np.int8)
+        self.shape = np.zeros(size, dtype=np.int8)
+
+    '''
+    Adds an effect to the grids, merging it with any of the same type in that cell
+    '''
+    def add(self, effect: 'EffectComponent', position: Vector2):
+        x, y = int(position[0]), int(position[1])
+        height, width = self.alive.shape[1:]
+        if not (0 <= x < width and 0 <= y < height):
+            return
+        index = self.rules.names.index(effect.name)
+        if not self.alive[index, y, x]:
+            self.energy[index, y, x] = 0
+        self.alive[index, y, x] = True
+        self.energy[index, y, x] += effect.energy
+        self.direction[index, y, x] = grid_direction(effect.direction)
+        self.shape[index, y, x] = effect.shape
+
+    '''
+    Updates the sprite batches to the current grids. Batches that did not change keep their positions list, so they are not redrawn.
+    '''
+    def update_batches(self):
+        for index, e in enumerate(self.batches):
+            ys, xs = np.nonzero(self.alive[index])
+            positions = list(zip(xs.tolist(), ys.tolist()))
+            if positions != e.sprite_batch.positions:
+                e.sprite_batch.positions = positions
+
+    '''
+    Harvests the tiles under the given cells for an effect type, and returns the energy gained by each
+    '''
+    def harvest(self, index: int, tiles: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        tile = tiles[ys, xs]
+        harvested = self.rules.harvests[index, tile]
+        tiles[ys[harvested], xs[harvested]] = self.rules.next_tile[index, tile[harvested]]
+        return self.rules.energy_gain[index, tile]
+
+    '''
+    Builds the propagation requests of the emitting cells of an effect type, following the same shape rules as effect_update_system.
+    Returns arrays of the source (index into the given cells), target y and x, energy, shape and rank.
+    The rank is the order in which each source's requests are resolved.
+    '''
+    def requests(self, index: int, tiles: np.ndarray, ys: np.ndarray, xs: np.ndarray, energy: np.ndarray, direction: np.ndarray, shape: np.ndarray):
+        rules = self.rules
+        height, width = tiles.shape
+        parts = []
+
+        def tiles_at(ry: np.ndarray, rx: np.ndarray) -> np.ndarray:
+            on_map = (ry >= 0) & (ry < height) & (rx >= 0) & (rx < width)
+            return np.where(on_map, tiles[ry.clip(0, height - 1), rx.clip(0, width - 1)], NO_TILE)
+
+        # Requests within a source are sorted by key. Forced requests go first, then the others in a random order.
+        def request(sources: np.ndarray, dx: np.ndarray, dy: np.ndarray, amount: np.ndarray, new_shape: int | np.ndarray, key: np.ndarray):
+            parts.append((sources, ys[sources] + dy, xs[sources] + dx, amount, np.broadcast_to(new_shape, len(sources)), key))
+
+        def chain(sources: np.ndarray, dx: np.ndarray, dy: np.ndarray):
+            tile = tiles_at(ys[sources] + dy, xs[sources] + dx)
+            chained = rules.chains[index, tile] & (self.rng.random(len(sources)) < rules.chain_probability[index, tile])
+            request(sources[chained], dx[chained], dy[chained], rules.chain_energy[index, tile[chained]], SHAPE_NONE, 1 + self.rng.random(chained.sum()))
+
+        offset = GRID_DIRECTIONS[direction]
+        dx, dy = offset[:, 0], offset[:, 1]
+
+        # Waves and lances transfer all energy forward
+        forward = np.flatnonzero((shape == SHAPE_WAVE) | (shape == SHAPE_LANCE))
+        request(forward, dx[forward], dy[forward], energy[forward] - 1, shape[forward], np.zeros(len(forward)))
+
+        # Waves start waves in valid adjacent tiles. They never chain.
+        waves = np.flatnonzero(shape == SHAPE_WAVE)
+        for rank, (nx, ny) in enumerate(((dy[waves], -dx[waves]), (-dy[waves], dx[waves]))):
+            valid = rules.propagates[index, tiles_at(ys[waves] + ny, xs[waves] + nx)]
+            request(waves[valid], nx[valid], ny[valid], np.zeros(valid.sum()), SHAPE_WAVE, np.full(valid.sum(), 1 + rank))
+
+        # Lances chain to the sides
+        lances = np.flatnonzero(shape == SHAPE_LANCE)
+        chain(lances, dy[lances], -dx[lances])
+        chain(lances, -dy[lances], dx[lances])
+
+        # Fills split their energy between all valid cardinals
+        fills = np.flatnonzero(shape == SHAPE_FILL)
+        cardinals = GRID_DIRECTIONS[:GRID_NO_DIRECTION]
+        valid = rules.propagates[index, tiles_at(ys[fills, None] + cardinals[:, 1], xs[fills, None] + cardinals[:, 0])]
+        counts = valid.sum(axis=1)
+        sources, sides = np.nonzero(valid)
+        request(fills[sources], cardinals[sides, 0], cardinals[sides, 1], np.ceil(energy[fills[sources]]) / counts[sources], SHAPE_FILL, self.rng.random(len(sources)))
+
+        # Everything else chains in any direction
+        others = np.flatnonzero(shape == SHAPE_NONE)
+        for cx, cy in cardinals.tolist():
+            chain(others, np.full(len(others), cx), np.full(len(others), cy))
+
+        sources, ry, rx, amount, new_shape, key = (np.concatenate(column) for column in zip(*parts))
+        order = np.lexsort((key, sources))
+        sources, ry, rx, amount, new_shape = sources[order], ry[order], rx[order], amount[order], new_shape[order]
+        rank = np.arange(len(sources)) - np.searchsorted(sources, sources)
+        return sources, ry, rx, amount, new_shape, rank
+
+    '''
+    Advances every effect by one turn, changing the tiles of the map. Returns the damage dealt to each cell.
+
+    This follows the rules of effect_update_system, but all cells move at once rather than one after another:
+    Blocking is checked against the effects at the start of the turn, and requests of the same type that land in the same cell are merged.
+    Merged effects add their energy, and take their direction and shape from the largest request.
+    '''
+    def step(self, map: TilemapComponent) -> np.ndarray:
+        rules = self.rules
+        original = map.as_array()
+        height, width = original.shape
+        self.resize((height, width))
+
+        bounds = map.bounds.clip(Rect(0, 0, width, height))
+        inside = (slice(bounds.top, bounds.bottom), slice(bounds.left, bounds.right))
+        tiles = np.full((height, width), NO_TILE, dtype=np.uint8)
+        tiles[inside] = original[inside]
+        before = tiles.copy()
+
+        damage = np.zeros((height, width), dtype=np.int64)
+        occupied = self.alive.copy()
+        consumed = np.zeros_like(self.alive)
+        results = []
+
+        for index in range(len(rules.names)):
+            ys, xs = np.nonzero(self.alive[index])
+            if not len(ys):
+                continue
+            energy = self.energy[index, ys, xs] + self.harvest(index, tiles, ys, xs)
+
+            # Propagation
+            sources = np.flatnonzero(energy > 1)
+            np.add.at(damage, (ys[sources], xs[sources]), rules.damage[index])
+            source, ry, rx, amount, shape, rank = self.requests(
+                index, tiles, ys[sources], xs[sources], energy[sources],
+                self.direction[index, ys[sources], xs[sources]], self.shape[index, ys[sources], xs[sources]]
+            )
+
+            # Occupied cells block requests, unless the occupant is consumed
+            on_map = (ry >= 0) & (ry < height) & (rx >= 0) & (rx < width)
+            cy, cx = ry.clip(0, height - 1), rx.clip(0, width - 1)
+            occupants = occupied[:, cy, cx] & on_map
+            consumes = rules.consumes[index][:, None]
+            blocked = (occupants & ~consumes).any(axis=0)
+            eaten, requests = np.nonzero(occupants & consumes)
+            consumed[eaten, cy[requests], cx[requests]] = True
+
+            # Each source resolves its requests in order, and never transfers below 1 energy
+            budget = np.maximum(0, energy[sources] - 1)
+            transfer = np.zeros(len(source))
+            for r in range(rank.max(initial=-1) + 1):
+                resolved = np.flatnonzero((rank == r) & ~blocked)
+                transfer[resolved] = np.minimum(amount[resolved], budget[source[resolved]])
+                budget[source[resolved]] -= transfer[resolved]
+            spent = np.zeros(len(sources))
+            np.add.at(spent, source, transfer)
+            energy[sources] -= spent
+
+            # New effects harvest and deal damage straight away. Requests off the map are lost.
+            spawn = np.flatnonzero(~blocked & on_map)
+            cells, merged, counts = np.unique(ry[spawn] * width + rx[spawn], return_inverse=True, return_counts=True)
+            largest = spawn[np.lexsort((transfer[spawn], merged))[np.cumsum(counts) - 1]]
+            spawn_energy = np.zeros(len(cells))
+            np.add.at(spawn_energy, merged, transfer[spawn])
+            spawn_ys, spawn_xs = np.divmod(cells, width)
+            spawn_energy += self.harvest(index, tiles, spawn_ys, spawn_xs)
+            np.add.at(damage, (spawn_ys, spawn_xs), rules.damage[index] * counts)
+            spawn_direction = self.direction[index, ys[sources], xs[sources]][source[largest]]
+
+            # Decay
+            energy -= 1
+            survived = energy > 0
+            results.append((
+                index,
+                (ys[survived], xs[survived], energy[survived]),
+                (spawn_ys, spawn_xs, spawn_energy, spawn_direction, shape[largest]),
+            ))
+
+        self.alive[:] = False
+        for index, (ys, xs, energy), _ in results:
+            self.alive[index, ys, xs] = True
+            self.energy[index, ys, xs] = energy
+        self.alive &= ~consumed
+        for index, _, (spawn_ys, spawn_xs, spawn_energy, spawn_direction, spawn_shape) in results:
+            self.alive[index, spawn_ys, spawn_xs] = True
+            self.energy[index, spawn_ys, spawn_xs] = spawn_energy
+            self.direction[index, spawn_ys, spawn_xs] = spawn_direction
+            self.shape[index, spawn_ys, spawn_xs] = spawn_shape
+
+        changed_ys, changed_xs = np.nonzero(tiles != before)
+        map.set_tiles(changed_xs, changed_ys, tiles[changed_ys, changed_xs])
+        return damage
+
+
+'''
+The grid effect update system:
+Advances the effect grids, and applies their damage to the player and enemies.
+Only run during the effects turn.
 '''
-Mounts the effect updating system
+def effect_grid_update_system(group: EntityGroup):
+
+    map: TilemapComponent = group.query_singleton('tilemap').tilemap
+    collision: CollisionComponent = group.query_singleton('collision').collision
+    grid: EffectGridComponent = group.query_singleton('effect_grid').effect_grid
+    if grid.alive is None or not grid.alive.any():
+        return
+
+    damage = grid.step(map)
+    height, width = damage.shape
+    for layer in (motion.LAYER_PLAYER, motion.LAYER_ENEMIES):
+        for (x, y), entities in collision.layers[layer].items():
+            if 0 <= x < width and 0 <= y < height and damage[y, x]:
+                for e in entities:
+                    e.health.health -= damage.item(y, x)
+
+    grid.batches_stale = True
+
+
 '''
-def mount_effect_system(group: EntityGroup):
-    group.mount_system(effect_update_system)
+The grid effect batch system:
+Updates the sprite batches once per frame if the grids have changed, rather than for every change.
+'''
+def effect_grid_batch_system(group: EntityGroup):
+    grid: EffectGridComponent = group.query_singleton('effect_grid').effect_grid
+    if not grid.batches_stale:
+        return
+
+    grid.update_batches()
+    grid.batches_stale = False
+    group.query_singleton('camera').camera.mark_dirty()
+
+
+'''
+Mounts the effect updating system.
+If grid is set, effects are advanced by the grid engine instead. See: EffectGridComponent
+Effects are still created as entities (see: create_effect), but are moved into the grids as they are added to the group.
+'''
+def mount_effect_system(group: EntityGroup, grid: bool = False):
+    if not grid:
+        group.mount_system(effect_update_system, run_if('turn', 'state', turn.TURN_EFFECTS))
+        return
+
+    e = Entity("effect_grid")
+    e.effect_grid = EffectGridComponent(rules=EffectGridRules(EFFECT_TEMPLATES))
+    for name, template in EFFECT_TEMPLATES.items():
+        batch = Entity(f"effect-grid-{name}")
+        batch.sprite_batch = SpriteBatchComponent(surface=template.sprite.surface, layer=motion.LAYER_EFFECTS)
+        e.effect_grid.batches.append(batch)
+        group.add(batch)
+    group.add(e)
+
+    def on_effect_added(effect_entity: Entity):
+        map: TilemapComponent = group.query_singleton('tilemap').tilemap
+        e.effect_grid.resize((len(map.map), len(map.map[0])))
+        e.effect_grid.add(effect_entity.effect, effect_entity.motion.position)
+        e.effect_grid.batches_stale = True
+        group.remove(effect_entity)
+    group.observe(on_effect_added, None, 'effect', 'motion')
+
+    group.mount_system(effect_grid_update_system, run_if('turn', 'state', turn.TURN_EFFECTS))
+    group.mount_system(effect_grid_batch_system)
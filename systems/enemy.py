@@ -1,5 +1,5 @@
 from pygame import Vector2
-from engine.ecs import Entity, EntityGroup, enumerate_component
+from engine.ecs import Entity, EntityGroup, enumerate_component, factory, run_if
 from .motion import MotionComponent
 from .sprites import SpriteComponent
 from .player import PlayerComponent
@@ -10,9 +10,9 @@ from . import turn
 from . import motion
 from . import tilemap
 
-from math import copysign
-from random import choice
-from queue import PriorityQueue
+import heapq
+import math
+import numpy as np
 
 '''
 A component that represents a generic enemy
@@ -21,22 +21,121 @@ A component that represents a generic enemy
 class EnemyComponent:
     damage: int
 
+
+NEIGHBORS = ((1, 0), (-1, 0), (0, 1), (0, -1)) # Right, left, down, up
+
+'''
+A shared flow field for pathing towards a target (the player).
+This is a reverse Dijkstra search out from the target, over the tiles within the tilemap bounds,
+where the distance of each tile is the cost of the cheapest path from it to the target (see: get_cost).
+
+The search is expanded lazily, only as far as is needed to answer lookups,
+and is reused until the target moves, or the tilemap changes.
+'''
+@enumerate_component("flow_field")
+class FlowFieldComponent:
+    target: tuple[int, int] = None
+    revision: int = -1
+    bounds: tuple[int, int, int, int] = None
+    costs: list[float] = factory(list) # The cost of entering each tile
+    distance: list[float] = factory(list)
+    settled: list[bool] = factory(list)
+    frontier: list[tuple[float, int]] = factory(list)
+
+    '''
+    Restarts the search if the target, tilemap contents or bounds have changed
+    '''
+    def update(self, tm: TilemapComponent, target: Vector2):
+        target = (int(target[0]), int(target[1]))
+        bounds = tuple(tm.bounds)
+        if target == self.target and tm.revision == self.revision and bounds == self.bounds:
+            return
+
+        self.target = target
+        self.revision = tm.revision
+        self.bounds = bounds
+        size = tm.bounds.width * tm.bounds.height
+        self.costs = COST_TABLE[tm.region()].ravel().tolist()
+        self.distance = [math.inf] * size
+        self.settled = [False] * size
+        self.frontier = []
+        if tm.contains(target):
+            i = self._index(target)
+            self.distance[i] = 0
+            self.frontier.append((0, i))
+
+    '''
+    Returns the velocity to take from a position, along the cheapest path to the target
+    '''
+    def next_step(self, tm: TilemapComponent, pos: Vector2) -> Vector2:
+        x, y = int(pos[0]), int(pos[1])
+        if (x, y) == self.target:
+            return Vector2(0)
+
+        best_cost = math.inf
+        best_step = Vector2(0)
+        for dx, dy in NEIGHBORS:
+            neighbor = (x + dx, y + dy)
+            if not tm.contains(neighbor):
+                continue
+            i = self._index(neighbor)
+            self._expand_until(i)
+            cost = self.costs[i] + self.distance[i]
+            if cost < best_cost:
+                best_cost = cost
+                best_step = Vector2(dx, dy)
+        return best_step
+
+    '''
+    Continues the search until the tile at the index is settled (or every reachable tile is)
+    '''
+    def _expand_until(self, index: int):
+        left, top, width, height = self.bounds
+        costs = self.costs
+        distance = self.distance
+        settled = self.settled
+        frontier = self.frontier
+        while not settled[index] and len(frontier):
+            d, i = heapq.heappop(frontier)
+            if settled[i]:
+                continue
+            settled[i] = True
+
+            # Moving from any neighbour onto this tile costs the same
+            x, y = left + i % width, top + i // width
+            d += costs[i]
+            for dx, dy in NEIGHBORS:
+                nx, ny = x + dx, y + dy
+                if left <= nx < left + width and top <= ny < top + height:
+                    n = (ny - top) * width + (nx - left)
+                    if d < distance[n]:
+                        distance[n] = d
+                        heapq.heappush(frontier, (d, n))
+
+    def _index(self, coord: tuple[int, int]) -> int:
+        left, top, width, _ = self.bounds
+        return (coord[1] - top) * width + (coord[0] - left)
+
 '''
 Update enemy systems including motion and when to do damage to player
 (based on sharing same position on grid)
+Only run while the turn is not waiting on user input, as enemies cannot move or be damaged otherwise.
 '''
 def enemy_update_system(group: EntityGroup):
 
     player = group.query_singleton('player')
     t: TurnComponent = group.query_singleton('turn').turn
     tm: TilemapComponent = group.query_singleton('tilemap').tilemap
+    flow_field: FlowFieldComponent = group.query_singleton('flow_field').flow_field
+
+    if t.state == turn.TURN_ENEMY:
+        flow_field.update(tm, player.motion.position)
 
     for e in group.query('enemy', 'health'):
 
         if t.state == turn.TURN_ENEMY:
             motion: MotionComponent = e.motion
-            mtp = a_star(tm.map, (e.motion.position.x, e.motion.position.y), (player.motion.position.x, player.motion.position.y))
-            motion.velocity = mtp
+            motion.velocity = flow_field.next_step(tm, motion.position)
 
             if player.motion.position == e.motion.position:
                 player.health.health -= e.enemy.damage
@@ -48,33 +147,14 @@ def enemy_update_system(group: EntityGroup):
 
 
 '''
-Mount system
+Mount system, and the flow field shared by all enemies
 '''
 def mount_enemy_system(group: EntityGroup):
-    group.mount_system(enemy_update_system)
-
-'''
-Immediate motion next step for A* calculating the velocity from the
-enemy's current and next path index
-'''
-def calculate_velocity(p_pos: Vector2, e_pos: Vector2):
+    e = Entity("flow_field")
+    e.flow_field = FlowFieldComponent()
+    group.add(e)
 
-    delta = p_pos - e_pos
-
-    if not delta:
-        return delta
-    
-    velocity_x = Vector2(copysign(1.0, delta.x), 0)
-    velocity_y = Vector2(0, copysign(1.0, delta.y))
-
-    # If neither are in plane with player, choose random one
-    if delta.x != 0 and delta.y != 0:
-        return choice([velocity_x, velocity_y])
-
-    if delta.x != 0:
-        return velocity_x
-    else:
-        return velocity_y
+    group.mount_system(enemy_update_system, run_if('turn', 'waiting', False))
 
 def create_enemy(position = tuple[int, int]):
     enemy = Entity("enemy")
@@ -95,76 +175,10 @@ COST_MAPPING = {
 }
 
 '''
-Calculating cost of individual tile for A*
+Calculating cost of entering an individual tile
 '''
 def get_cost(value):
     return COST_MAPPING.get(value, 5)  # Default to infinity for unrecognized values
 
-'''
-Heuristic function (Manhattan distance for grid)
-'''
-def heuristic(a, b):
-    return abs(a[0] - b[0]) + abs(a[1] - b[1])
-
-'''
-A* algorithm implementation including. Returns next immediate velocity for enemy to take
-'''
-def a_star(map, e_pos, p_pos):
-
-    frontier = PriorityQueue()
-    frontier.put((0, e_pos))  # Priority queue stores (priority, node)
-    
-    came_from = {}
-    cost_so_far = {}
-    
-    came_from[e_pos] = None
-    cost_so_far[e_pos] = 0
-    
-    while not frontier.empty():
-        _, current = frontier.get()
-        
-        if current == p_pos:
-            break
-        
-        # Define the possible moves (up, down, left, right)
-        neighbors = [
-            (current[0] + 1, current[1]),   # Right 
-            (current[0] - 1, current[1]),   # Left
-            (current[0], current[1] + 1),   # Down
-            (current[0], current[1] - 1)    # Up
-        ]
-        
-        for next in neighbors:
-            # Check if next position is within grid bounds
-
-            if 0 <= next[0] < len(map) and 0 <= next[1] < len(map[0]):
-                # Calculate the cost to move to the neighbor
-                # TODO: Check, this might be reversed
-                next_x = int(next[0])
-                next_y = int(next[1])
-                new_cost = cost_so_far[current] + get_cost(map[next_y][next_x])
-                
-                # If the neighbor hasn't been visited or a cheaper path is found
-                if next not in cost_so_far or new_cost < cost_so_far[next]:
-                    cost_so_far[next] = new_cost
-                    priority = new_cost + heuristic(p_pos, next)
-                    frontier.put((priority, next))
-                    came_from[next] = current
-    
-    # Reconstruct path
-    path = []
-    current = p_pos
-    while current != e_pos:  # Trace the path back from goal to start
-        path.append(current)
-        current = came_from[current]
-    path.append(e_pos)
-    path.reverse()  # Reverse the path to start -> goal
-
-    velocity = Vector2(0)
-
-    # Because system uses last two path nodes for A* to calculate next immediate 
-    # vector for enemy to take towards player, with paht[0] being the current position
-    if(len(path)>= 2):
-        velocity = calculate_velocity(Vector2(path[1]), Vector2(path[0]))
-    
-    return velocity  # Return the path and total cost
\ No newline at end of file
+# get_cost as a lookup table indexed by tile
+COST_TABLE = np.array([get_cost(tile) for tile in range(256)], dtype=np.float64)
@@ -1,4 +1,4 @@
-from engine.ecs import EntityGroup, enumerate_component
+from engine.ecs import EntityGroup, enumerate_component, run_if
 
 @enumerate_component("health")
 class HealthComponent:
@@ -7,6 +7,7 @@ class HealthComponent:
 
 '''
 Update health system for 
+Only run while the turn is not waiting on user input, as nothing takes damage otherwise.
 '''
 def update_health_system(group: EntityGroup):
     for e in group.query("health"):
@@ -18,6 +19,6 @@ def update_health_system(group: EntityGroup):
 Mount health system
 '''
 def mount_health_system(group: EntityGroup):
-    group.mount_system(update_health_system)
+    group.mount_system(update_health_system, run_if('turn', 'waiting', False))
     pass
 
@@ -1,6 +1,6 @@
 import random
 from pygame import Rect, Surface, Vector2
-from engine.ecs import Entity, EntityGroup, enumerate_component, factory
+from engine.ecs import Entity, EntityGroup, Prefab, enumerate_component, factory, run_if
 from systems.controls import ControlComponent
 from systems.enemy import create_enemy
 from systems.motion import Direction, MotionComponent
@@ -12,8 +12,8 @@ from systems.utils import round_vector
 
 
 ENEMY_TYPES = {
-    'mook': create_enemy((0, 0)),
-    'boss': create_enemy((0, 0))
+    'mook': Prefab(create_enemy((0, 0))),
+    'boss': Prefab(create_enemy((0, 0)))
 }
 
 
@@ -84,11 +84,10 @@ class GameComponent:
 
     state: int = 0
 
+'''
+Only run while playing
+'''
 def level_progression_system(group: EntityGroup):
-    game: GameComponent = group.query_singleton('game').game
-    if game.state != game.STATE_PLAYING:
-        return
-
     enemy_entities = group.query('enemy')
     spawn_entities = group.query('spawn')
     level_entity = group.query_singleton('level', 'ui')
@@ -115,6 +114,9 @@ def level_progression_system(group: EntityGroup):
         else:
             print('Game Over. You win!')
 
+'''
+Only run while playing
+'''
 def spawn_enemy_system(group: EntityGroup):
     turn: TurnComponent = group.query_singleton('turn').turn
 
@@ -134,9 +136,10 @@ def spawn_enemy_system(group: EntityGroup):
         random_spawn = round_vector(Vector2(spawn_area.topleft) + Vector2(spawn_area.size) * random.random())
         spawn.last_spawned_turn = turn.number
         spawn.count -= 1
-        enemy = ENEMY_TYPES.get(spawn.enemy_type).clone()
+        prefab: Prefab = ENEMY_TYPES.get(spawn.enemy_type)
+        enemy = prefab.instantiate()
         enemy.motion.position = Vector2(random_spawn)
-        group.add(enemy)
+        group.add(enemy, prefab.mask)
 
 def game_state_system(group: EntityGroup):
     game_entity = group.query_singleton('game', 'ui')
@@ -184,6 +187,6 @@ def mount_level_system(group: EntityGroup, surface: Surface):
     group.add(level_entity)
 
     group.mount_system(game_state_system)
-    group.mount_system(level_progression_system)
-    group.mount_system(spawn_enemy_system)
+    group.mount_system(level_progression_system, run_if('game', 'state', GameComponent.STATE_PLAYING))
+    group.mount_system(spawn_enemy_system, run_if('game', 'state', GameComponent.STATE_PLAYING))
 
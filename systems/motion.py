@@ -1,8 +1,9 @@
 from enum import Enum
-from engine.ecs import EntityGroup, enumerate_component, factory
+from engine.columns import ColumnStore, ColumnView, attach_column_store
+from engine.ecs import Entity, EntityGroup, enumerate_component, factory, run_if
 from pygame import Vector2
+import numpy as np
 
-from .turn import TurnComponent
 from .tilemap import TilemapComponent
 from . import utils
 
@@ -27,17 +28,82 @@ class MotionComponent():
     velocity: Vector2 = factory(Vector2)
     layer: int | None = LAYER_NONE
 
+
+'''
+Columnar storage for motion components. Layers are stored as -1 for LAYER_NONE.
+'''
+class MotionColumns(ColumnStore):
+    def __init__(self):
+        super().__init__({
+            'position': (np.float64, (2,)),
+            'velocity': (np.float64, (2,)),
+            'layer': (np.int8, ()),
+        })
+
+'''
+A motion component backed by MotionColumns. It behaves like a MotionComponent,
+but vectors are copied out of (and into) the columns, so they must be reassigned rather than modified in place.
+'''
+class MotionView(ColumnView):
+    __slots__ = ()
+
+    @staticmethod
+    def bind(store: MotionColumns, slot: int, motion: MotionComponent) -> 'MotionView':
+        view = MotionView(store, slot)
+        view.position = motion.position
+        view.velocity = motion.velocity
+        view.layer = motion.layer
+        return view
+
+    @property
+    def position(self) -> Vector2:
+        return Vector2(self.store.position.item(self.slot, 0), self.store.position.item(self.slot, 1))
+
+    @position.setter
+    def position(self, value: Vector2):
+        self.store.position[self.slot, 0] = value[0]
+        self.store.position[self.slot, 1] = value[1]
+
+    @property
+    def velocity(self) -> Vector2:
+        return Vector2(self.store.velocity.item(self.slot, 0), self.store.velocity.item(self.slot, 1))
+
+    @velocity.setter
+    def velocity(self, value: Vector2):
+        self.store.velocity[self.slot, 0] = value[0]
+        self.store.velocity[self.slot, 1] = value[1]
+
+    @property
+    def layer(self) -> int | None:
+        layer = self.store.layer.item(self.slot)
+        return LAYER_NONE if layer < 0 else layer
+
+    @layer.setter
+    def layer(self, value: int | None):
+        self.store.layer[self.slot] = -1 if value == LAYER_NONE else value
+
+    def detach(self) -> MotionComponent:
+        return MotionComponent(position=self.position, velocity=self.velocity, layer=self.layer)
+
+
+'''
+Component holding the columnar motion store (when enabled)
+'''
+@enumerate_component("motion_columns")
+class MotionColumnsComponent():
+    store: MotionColumns = factory(MotionColumns)
+
+
 '''
 The motion update system:
-Update any entities with motions components
+Update any entities with motions components, and move them in the collision index.
+Only run while the turn is not waiting on user input.
 '''
 def motion_update_system(group: EntityGroup):
 
-    t: TurnComponent = group.query_singleton('turn').turn
-    if t.waiting:
-        return
-    
     tilemap: TilemapComponent = group.query_singleton("tilemap").tilemap
+    collision = group.query_singleton("collision").collision
+    moved = False
 
     # Update the position of all entities with a velocity
     for e in group.query('motion'):
@@ -46,11 +112,52 @@ def motion_update_system(group: EntityGroup):
             new_position = motion.position + motion.velocity
             if tilemap.contains(new_position):
                 motion.position = new_position
+                collision.move(e)
+                moved = True
             motion.velocity = Vector2(0)
 
+    if moved:
+        group.query_singleton('camera').camera.mark_dirty()
+
 '''
-Mounts systems for updating motion components
+The columnar motion update system:
+Same as the motion update system, but integrates every entity in a single vectorized pass.
 '''
-def mount_motion_system(group: EntityGroup):
-    group.mount_system(motion_update_system)
+def motion_columns_update_system(group: EntityGroup):
+
+    tilemap: TilemapComponent = group.query_singleton("tilemap").tilemap
+    collision = group.query_singleton("collision").collision
+    store: MotionColumns = group.query_singleton('motion_columns').motion_columns.store
+
+    velocity = store.velocity[:store.size]
+    moving = np.flatnonzero(store.active[:store.size] & velocity.any(axis=1))
+    if not len(moving):
+        return
+
+    new_position = store.position[moving] + velocity[moving]
+    inside = tilemap.contains_many(new_position)
+    moved = moving[inside]
+    store.position[moved] = new_position[inside]
+    velocity[moving] = 0
+
+    for slot in moved.tolist():
+        collision.move(store.entities[slot])
+
+    if len(moved):
+        group.query_singleton('camera').camera.mark_dirty()
+
+'''
+Mounts systems for updating motion components.
+If columnar is set, motion components are stored in numpy columns while their entities are in the group.
+'''
+def mount_motion_system(group: EntityGroup, columnar: bool = False):
+    if not columnar:
+        group.mount_system(motion_update_system, run_if('turn', 'waiting', False))
+        return
+
+    e = Entity("motion_columns")
+    e.motion_columns = MotionColumnsComponent()
+    group.add(e)
+    attach_column_store(group, 'motion', e.motion_columns.store, MotionView.bind)
 
+    group.mount_system(motion_columns_update_system, run_if('turn', 'waiting', False))
@@ -1,4 +1,4 @@
-from engine.ecs import Entity, EntityGroup, enumerate_component
+from engine.ecs import Entity, EntityGroup, enumerate_component, run_if
 from pygame import Vector2
 
 from systems.ui import UIComponent
@@ -33,19 +33,13 @@ def get_direction_command(actions: list[str]) -> Vector2 | None:
 '''
 The player update system:
 Update the players velocity based on the controls
+Only run during the player turn.
 '''
 def player_update_system(group: EntityGroup):
 
     t: turn.TurnComponent = group.query_singleton("turn").turn
     player = group.query_singleton('player', 'motion', 'health')
-    health_bar = group.query_singleton('health', 'motion', 'ui')
-
-    health_bar.ui.text = "Health: " + str(player.health.health)
 
-    if t.state != turn.TURN_PLAYER:
-        # Nothing we can do
-        return
-    
     if not player.health.is_alive:
         game = group.query_singleton('game').game
         game.state = game.STATE_GAME_OVER
@@ -61,14 +55,28 @@ def player_update_system(group: EntityGroup):
     if "skip_start" in controls.actions:
         t.waiting = False
     
+    sprite_resource = None
     if "up_start" in controls.actions:
-        player.sprite = SpriteComponent.from_resource("player/player_up.png")
+        sprite_resource = "player/player_up.png"
     elif "right_start" in controls.actions:
-        player.sprite = SpriteComponent.from_resource("player/player_r.png")
+        sprite_resource = "player/player_r.png"
     elif "down_start" in controls.actions:
-        player.sprite = SpriteComponent.from_resource("player/player_down.png")
+        sprite_resource = "player/player_down.png"
     elif "left_start" in controls.actions:
-        player.sprite = SpriteComponent.from_resource("player/player_l.png")
+        sprite_resource = "player/player_l.png"
+
+    if sprite_resource:
+        player.sprite = SpriteComponent.from_resource(sprite_resource)
+        group.query_singleton('camera').camera.mark_dirty()
+
+'''
+The player health system:
+Keeps the health label up to date. Runs every frame, so damage taken outside the player turn is shown straight away.
+'''
+def player_health_system(group: EntityGroup):
+    player = group.query_singleton('player', 'motion', 'health')
+    health_bar = group.query_singleton('health', 'motion', 'ui')
+    health_bar.ui.text = "Health: " + str(player.health.health)
 
 '''
 Adds the player character, and mounts systems for updating the player with the control inputs
@@ -88,4 +96,5 @@ def mount_player_system(group: EntityGroup):
     health_box.health = player.health
     group.add(health_box)
 
-    group.mount_system(player_update_system)
+    group.mount_system(player_update_system, run_if('turn', 'state', turn.TURN_PLAYER))
+    group.mount_system(player_health_system)
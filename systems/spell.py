@@ -1,6 +1,7 @@
 from pygame import Surface, Vector2
 import pygame
-from engine.ecs import Entity, EntityGroup, enumerate_component, factory
+from engine.ecs import Derived, Entity, EntityGroup, enumerate_component, factory, run_if
+from systems.collision import cell_key
 from systems.controls import ControlComponent
 from systems.effect import EffectComponent, create_effect
 from systems.motion import Direction, MotionComponent
@@ -26,49 +27,112 @@ class SelectedSpellComponent:
     spell_casting_start: Vector2 = None
     target_tile: Tile = None
     spell_color: tuple[int,int,int] = None
+    preview: tuple[Vector2, Vector2, tuple[int,int,int]] = None # The cast preview the camera was last marked dirty for
+    preview_rect: pygame.Rect = None # The screen area of the drawn preview
 
 @enumerate_component("tile_area")
 class TileAreaComponent:
-    tile_positions: list[Vector2] = factory(list)
-
-
-def find_positions(map: TilemapComponent, coords: Vector2, value, checked = []):
-    tile = map.get_tile(coords)
-    positions = []
-
-    if tile == value and coords not in checked:
-        positions.append(coords)
-
-        to_check = [
-            coords + Direction.UP,
-            coords + Direction.RIGHT,
-            coords + Direction.DOWN,
-            coords + Direction.LEFT
-        ]
-
-        for check_coord in to_check:
-            if check_coord in checked:
-                continue
-
-            positions += find_positions(map, check_coord, value, checked + positions)
-
-    return positions
-
+    tile_positions: set[tuple[int,int]] = factory(set)
+    derived: Derived = factory(Derived) # Keyed on the player cell, target tile, and tilemap contents
+
+
+'''
+Labels the 4-connected regions of matching tiles within the tilemap bounds,
+so the region containing a tile can be looked up without a flood fill each time.
+Regions touching a tile changed through set_tile are discarded, and their tiles are relabelled when next looked up.
+Any two adjacent matching tiles are either in the same region, or both unlabelled.
+'''
+@enumerate_component("tile_regions")
+class TileRegionsComponent:
+    tilemap: TilemapComponent = None
+    changed: set[tuple[int,int]] = factory(set) # See: TilemapComponent.watch
+    bounds: tuple[int,int,int,int] = None
+    labels: dict[tuple[int,int], int] = factory(dict)
+    regions: dict[int, set[tuple[int,int]]] = factory(dict)
+    unlabelled: set[tuple[int,int]] = factory(set)
+    next_label: int = 0
+
+    '''
+    Brings the labels up to date with the tilemap
+    '''
+    def update(self, map: TilemapComponent):
+        if map is not self.tilemap:
+            self.tilemap = map
+            self.changed = map.watch()
+            self.bounds = None
+
+        bounds = tuple(map.bounds)
+        if bounds != self.bounds:
+            self.bounds = bounds
+            self.labels = {}
+            self.regions = {}
+            self.unlabelled = {(x, y) for y in range(map.bounds.top, map.bounds.bottom) for x in range(map.bounds.left, map.bounds.right)}
+        else:
+            # Only the regions touching a changed tile can split or merge
+            for x, y in self.changed:
+                for coord in ((x, y), (x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                    region = self.regions.pop(self.labels.get(coord), None)
+                    if region:
+                        self.unlabelled |= region
+        self.changed.clear()
+
+    '''
+    Returns the tiles in the same region as the given tile
+    '''
+    def region_at(self, coord: tuple[int,int]) -> set[tuple[int,int]]:
+        if coord in self.unlabelled:
+            self.label(coord)
+        return self.regions.get(self.labels.get(coord), set())
+
+    '''
+    Flood fills the region containing an unlabelled tile
+    '''
+    def label(self, start: tuple[int,int]):
+        map = self.tilemap
+        unlabelled = self.unlabelled
+        unlabelled.remove(start)
+        tile = map.get_tile(start)
+        region = {start}
+        to_check = [start]
+        while len(to_check):
+            x, y = to_check.pop()
+            for coord in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if coord in unlabelled and map.get_tile(coord) == tile:
+                    unlabelled.remove(coord)
+                    region.add(coord)
+                    to_check.append(coord)
+
+        label = self.next_label
+        self.next_label += 1
+        self.regions[label] = region
+        for coord in region:
+            self.labels[coord] = label
+
+
+'''
+Finds the tiles the selected spell can be cast from: the regions of the target tile next to the player.
+These are only recomputed when the player moves, the target tile changes, or the tilemap changes.
+'''
 def spell_tile_detection_system(group: EntityGroup):
     motion: MotionComponent = group.query_singleton('player', 'motion').motion
     tilemap: TilemapComponent = group.query_singleton('tilemap').tilemap
     selected_spell_entity = group.query_singleton('selected_spell', 'tile_area')
     selected_spell: SelectedSpellComponent = selected_spell_entity.selected_spell
     tile_area: TileAreaComponent = selected_spell_entity.tile_area
+    tile_regions: TileRegionsComponent = group.query_singleton('tile_regions').tile_regions
     target_tile = selected_spell.target_tile
-    positions = []
 
-    positions += find_positions(tilemap, motion.position + Direction.UP, target_tile, positions)
-    positions += find_positions(tilemap, motion.position + Direction.RIGHT, target_tile, positions)
-    positions += find_positions(tilemap, motion.position + Direction.DOWN, target_tile, positions)
-    positions += find_positions(tilemap, motion.position + Direction.LEFT, target_tile, positions)
-
-    tile_area.tile_positions = positions
+    def find_positions() -> set[tuple[int,int]]:
+        tile_regions.update(tilemap)
+        positions = set()
+        for direction in (Direction.UP, Direction.RIGHT, Direction.DOWN, Direction.LEFT):
+            coord = cell_key(motion.position + direction)
+            if tilemap.get_tile(coord) == target_tile:
+                positions |= tile_regions.region_at(coord)
+        return positions
+
+    inputs = (cell_key(motion.position), target_tile, id(tilemap), tilemap.revision, tuple(tilemap.bounds))
+    tile_area.tile_positions = tile_area.derived.get(inputs, find_positions)
     
 
 def spell_select_system(group: EntityGroup):
@@ -88,6 +152,9 @@ def spell_select_system(group: EntityGroup):
             break
 
 
+'''
+Only run while the turn is waiting on user input
+'''
 def spell_cast_system(group: EntityGroup):
     controls: ControlComponent = group.query_singleton('controls').controls
     selected_spell_entity: SelectedSpellComponent = group.query_singleton('selected_spell', 'tile_area')
@@ -96,20 +163,32 @@ def spell_cast_system(group: EntityGroup):
     tile_area: TileAreaComponent = selected_spell_entity.tile_area
     turn: TurnComponent = group.query_singleton('turn').turn
 
-    if not turn.waiting:
-        return
-    
-    if selected_spell.spell_casting_start:
-        camera_entity = group.query_singleton('camera', 'motion')
-        camera: CameraComponent = camera_entity.camera
-        offset, scale = camera.get_screenspace_transform(camera_entity.motion.position)
+    camera_entity = group.query_singleton('camera', 'motion')
+    camera: CameraComponent = camera_entity.camera
+
+    offset, scale = camera.get_screenspace_transform(camera_entity.motion.position)
+
+    preview = None
+    if selected_spell.spell_casting_start is not None:
         effect_direction = utils.closest_cardinal(controls.mouse_grid_position - selected_spell.spell_casting_start)
         if selected_spell.spell_color:
-            surface = Surface(Vector2(scale*2), pygame.SRCALPHA)
-            pygame.draw.line(surface, selected_spell.spell_color, Vector2(scale), Vector2(scale) + (effect_direction * scale), 5)
-            pygame.draw.circle(surface, selected_spell.spell_color, Vector2(scale), 8)
-            camera.surface.blit(surface, (selected_spell.spell_casting_start * scale + offset) - Vector2(scale))
-        
+            preview = (Vector2(selected_spell.spell_casting_start), effect_direction, selected_spell.spell_color)
+
+    if preview != selected_spell.preview:
+        if selected_spell.preview_rect:
+            camera.add_damage(selected_spell.preview_rect)
+        selected_spell.preview = preview
+        selected_spell.preview_rect = None
+        if preview:
+            selected_spell.preview_rect = pygame.Rect((selected_spell.spell_casting_start * scale + offset) - Vector2(scale), Vector2(scale*2))
+            camera.add_damage(selected_spell.preview_rect)
+
+    if preview and camera.redraw:
+        surface = Surface(Vector2(scale*2), pygame.SRCALPHA)
+        pygame.draw.line(surface, selected_spell.spell_color, Vector2(scale), Vector2(scale) + (effect_direction * scale), 5)
+        pygame.draw.circle(surface, selected_spell.spell_color, Vector2(scale), 8)
+        camera.blit(surface, (selected_spell.spell_casting_start * scale + offset) - Vector2(scale))
+
 
     if "mouse_0_start" in controls.actions:
         selected_spell.spell_casting_start = controls.mouse_grid_position
@@ -117,7 +196,8 @@ def spell_cast_system(group: EntityGroup):
         for spell_entity in group.query('spell'):
             spell: SpellComponent = spell_entity.spell
             
-            if spell.select_action == selected_spell.spell_action and selected_spell.spell_casting_start in tile_area.tile_positions:
+            if (spell.select_action == selected_spell.spell_action and selected_spell.spell_casting_start is not None
+                    and cell_key(selected_spell.spell_casting_start) in tile_area.tile_positions):
                 effect_entity = create_effect(spell.effect, selected_spell.spell_casting_start, effect_direction)
                 group.add(effect_entity)
                 turn.waiting = False
@@ -146,9 +226,13 @@ def mount_spell_system(group: EntityGroup):
     selected_spell_entity.motion = MotionComponent(position=Vector2(10, 50))
     selected_spell_entity.tile_area = TileAreaComponent()
 
+    tile_regions = Entity("tile_regions")
+    tile_regions.tile_regions = TileRegionsComponent()
+
     group.add_all(water_wave, plant_growth, spark, fire_lance, corrupt_fill, purify_fill)
     group.add(selected_spell_entity)
+    group.add(tile_regions)
 
     group.mount_system(spell_select_system)
     group.mount_system(spell_tile_detection_system)
-    group.mount_system(spell_cast_system)
\ No newline at end of file
+    group.mount_system(spell_cast_system, run_if('turn', 'waiting', True))
\ No newline at end of file
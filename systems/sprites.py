@@ -1,15 +1,17 @@
 from engine.assets import AssetPipeline
-from engine.ecs import Entity, EntityGroup, enumerate_component
+from engine.ecs import Entity, EntityGroup, enumerate_component, factory, run_if
 import os
 import math
 
+import numpy as np
 import pygame
 from pygame.surface import Surface
-from pygame import Color, Vector2
+from pygame import Color, Rect, Vector2, surfarray
 
 from systems.tilemap import TILE_SPRITES, TilemapComponent
 
-from .motion import MotionComponent
+from .motion import LAYER_COUNT, MotionComponent
+from .turn import TurnComponent
 
 
 
@@ -48,23 +50,322 @@ class SpriteComponent():
         return SpriteComponent(surface=surface)
 
 
+'''
+A component that draws one sprite at many positions, for things too numerous to be an entity each.
+It is drawn in its own layer, and needs no motion component, so it is never part of the collision index.
+Assign a new positions list rather than changing it in place, and mark the camera dirty.
+Dirty rects track the whole batch by the identity of that list.
+'''
+@enumerate_component("sprite_batch")
+class SpriteBatchComponent():
+    surface: Surface
+    layer: int
+    positions: list[tuple[float, float]] = factory(list)
+
+
 TILE_SCALE = 32
 
 '''
-A component that represents a camera
+A component that represents a camera.
+In render on change mode, frames are only drawn when something visible has been marked as changed.
+Changes are latched by the camera update system, so changes made after that are drawn on the next frame.
+
+In dirty rect mode, only the damaged areas of the surface are redrawn, and the rest is left from the previous frame.
+The sprite system works out the damage for a frame, and other drawing must go through blit to be clipped to it.
+Changes outside the sprite system are reported with add_damage, and drawn on the next frame.
 '''
 @enumerate_component("camera")
 class CameraComponent():
     surface: Surface
     scale: float = TILE_SCALE
+    render_on_change: bool = False
+    dirty: bool = True # Something visible has changed since the last redraw
+    redraw: bool = True # The current frame is being drawn
+    dirty_rects: bool = False
+    damage: list[Rect] = factory(list) # The disjoint areas being redrawn this frame
+    pending_damage: list[Rect] = factory(list) # Areas to redraw on the next frame
+
+    '''
+    Flags that something visible has changed, so the next frame will be redrawn
+    '''
+    def mark_dirty(self):
+        self.dirty = True
+
+    '''
+    Returns true if the window can wait for input rather than running frames.
+    That is only once nothing has changed since the last redraw, and the turn is waiting on the player.
+    '''
+    def is_idle(self, turn: TurnComponent) -> bool:
+        return turn.waiting and not self.dirty
+
+    '''
+    Flags that an area of the screen has changed, so it will be redrawn on the next frame
+    '''
+    def add_damage(self, rect: Rect):
+        if self.dirty_rects:
+            self.pending_damage.append(Rect(rect))
+        self.mark_dirty()
+
+    '''
+    Draws onto the camera surface. In dirty rect mode, this is clipped to the damaged areas.
+    '''
+    def blit(self, source: Surface, position: Vector2):
+        if not self.dirty_rects:
+            self.surface.blit(source, position)
+            return
+
+        rect = Rect(position, source.get_size())
+        for damage in self.damage:
+            if damage.colliderect(rect):
+                self.surface.set_clip(damage)
+                self.surface.blit(source, position)
+        self.surface.set_clip(None)
+
+    '''
+    Returns the areas of the screen that were redrawn, or None if the whole screen was
+    '''
+    def updated_rects(self) -> list[Rect] | None:
+        if not self.dirty_rects:
+            return None
+        return self.damage if self.redraw else []
 
     def get_screenspace_transform(self, pos: Vector2) -> tuple[Vector2, float]:
         screen_center = Vector2(self.surface.get_size()) / 2
         return (screen_center - (pos * self.scale), self.scale)
 
+'''
+A component that keeps the drawable entities bucketed by motion layer, in the order they were added.
+It is kept up to date as entities with a sprite and motion (or a sprite batch) are added to or removed from the group.
+See: mount_sprite_system
+'''
+@enumerate_component("render_list")
+class RenderListComponent():
+    layers: list[dict[Entity, None]] = factory(list)
+    drawn: dict[Entity, tuple[Surface, Rect, list | None]] = factory(dict) # The sprites, screen rects and batch positions drawn last frame, in dirty rect mode
+
+    def insert(self, e: Entity):
+        if e.motion.layer != None:
+            self.layers[e.motion.layer][e] = None
+
+    def remove(self, e: Entity):
+        if e.motion.layer != None:
+            self.layers[e.motion.layer].pop(e, None)
+
+    def insert_batch(self, e: Entity):
+        self.layers[e.sprite_batch.layer][e] = None
+
+    def remove_batch(self, e: Entity):
+        self.layers[e.sprite_batch.layer].pop(e, None)
+
+    @staticmethod
+    def from_layer_count(layers: int) -> 'RenderListComponent':
+        return RenderListComponent(layers=[ {} for _ in range(layers) ])
+
+
+DAMAGE_RECT_LIMIT = 64 # More damaged rects than this in a frame, and the whole screen is redrawn
+DAMAGE_AREA_LIMIT = 0.5 # Or if the damaged rects cover more than this share of the screen
+LOW_DETAIL_SCALE = 8 # Pixels per tile, below which tiles are drawn as flat colors
+UNKNOWN_TILE = 255 # Used for positions outside the map
+
+'''
+Returns a lookup table of the average color of each tile sprite, indexed by tile.
+Tiles without a sprite use the color of the unknown sprite.
+'''
+def average_tile_colors() -> np.ndarray:
+    colors = np.empty((256, 3), dtype=np.uint8)
+    colors[:] = surfarray.array3d(AssetPipeline.get_instance().get_image('tiles/unknown.png')).mean(axis=(0, 1)).round()
+    for tile, sprite in TILE_SPRITES.items():
+        colors[tile] = surfarray.array3d(sprite).mean(axis=(0, 1)).round()
+    return colors
+
+
+'''
+A component that caches the tilemap pre-rendered for the camera transform.
+The whole layer is redrawn when the tilemap, its bounds, or the transform change.
+Otherwise only the tiles changed through TilemapComponent.set_tile are redrawn.
+Below low_detail_scale pixels per tile, tiles are drawn in the average color of their sprite instead.
+'''
+@enumerate_component("tile_layer")
+class TileLayerComponent():
+    surface: Surface | None = None
+    position: tuple[int, int] = (0, 0) # Where the layer is drawn on screen
+    tilemap: TilemapComponent | None = None
+    changed: set[tuple[int, int]] = factory(set) # See: TilemapComponent.watch
+    bounds: Rect = factory(lambda: Rect(0, 0, 0, 0))
+    offset: Vector2 = factory(Vector2)
+    scale: float = 0
+    sprites: dict[int, Surface] = factory(dict)
+    unknown_sprite: Surface | None = None
+    low_detail_scale: float = LOW_DETAIL_SCALE
+    colors: np.ndarray | None = None # See: average_tile_colors
+
+    '''
+    Brings the layer up to date with the tilemap and camera transform.
+    Returns the screen rects of the redrawn tiles, or None if the whole layer was rebuilt.
+    '''
+    def update(self, tilemap: TilemapComponent, offset: Vector2, scale: float) -> list[Rect] | None:
+        if tilemap is not self.tilemap:
+            self.tilemap = tilemap
+            self.changed = tilemap.watch()
+            self.surface = None
+
+        if self.surface is None or scale != self.scale or offset != self.offset or tilemap.bounds != self.bounds:
+            self.rebuild(tilemap, offset, scale)
+            redrawn = None
+        else:
+            redrawn = [self.redraw_tile(tilemap, coord) for coord in self.changed if self.bounds.collidepoint(coord)]
+        self.changed.clear()
+        return redrawn
+
+    '''
+    Returns true if the layer no longer matches the tilemap
+    '''
+    def is_stale(self, tilemap: TilemapComponent) -> bool:
+        return tilemap is not self.tilemap or tilemap.bounds != self.bounds or len(self.changed) > 0
+
+    def is_low_detail(self) -> bool:
+        return self.scale < self.low_detail_scale
+
+    '''
+    Rescales the tile sprites, and redraws every tile within the bounds
+    '''
+    def rebuild(self, tilemap: TilemapComponent, offset: Vector2, scale: float):
+        self.bounds = tilemap.bounds.copy()
+        self.offset = Vector2(offset)
+        self.scale = scale
+
+        # Tiles are placed exactly where they would be blitted on screen, relative to the top left tile
+        self.position = (0, 0)
+        self.position = self.tile_position(self.bounds.topleft)
+        right, bottom = self.tile_position((self.bounds.right - 1, self.bounds.bottom - 1))
+        self.surface = Surface((max(0, right + math.ceil(scale)), max(0, bottom + math.ceil(scale))))
+
+        if self.is_low_detail():
+            self.draw_low_detail(tilemap)
+            return
+
+        tile_size = Vector2(math.ceil(scale))
+        self.sprites = {key: pygame.transform.scale(sprite, tile_size) for key, sprite in TILE_SPRITES.items()}
+        self.unknown_sprite = pygame.transform.scale(AssetPipeline.get_instance().get_image('tiles/unknown.png'), tile_size)
+
+        for y in range(self.bounds.top, self.bounds.bottom):
+            for x in range(self.bounds.left, self.bounds.right):
+                self.draw_tile(tilemap, (x, y))
+
+    '''
+    Returns the position of a tile within the layer
+    '''
+    def tile_position(self, coord: tuple[int, int]) -> tuple[int, int]:
+        screen_pos = Vector2(coord) * self.scale + self.offset - Vector2(self.scale / 2)
+        return (int(screen_pos.x) - self.position[0], int(screen_pos.y) - self.position[1])
+
+    '''
+    Redraws a single tile, and returns its rect on screen.
+    Scaled tiles can overlap their neighbours by a pixel, so the neighbours are redrawn (in the original order)
+    clipped to the tile, to give the same result as a full rebuild.
+    '''
+    def redraw_tile(self, tilemap: TilemapComponent, coord: tuple[int, int]) -> Rect:
+        x, y = coord
+        size = math.ceil(self.scale)
+        rect = Rect(self.tile_position(coord), (size, size))
+        self.surface.set_clip(rect)
+        for ny in range(max(y - 1, self.bounds.top), min(y + 2, self.bounds.bottom)):
+            for nx in range(max(x - 1, self.bounds.left), min(x + 2, self.bounds.right)):
+                self.draw_tile(tilemap, (nx, ny))
+        self.surface.set_clip(None)
+        return rect.move(self.position)
+
+    def draw_tile(self, tilemap: TilemapComponent, coord: tuple[int, int]):
+        if self.is_low_detail():
+            tile = tilemap.get_tile(coord)
+            size = math.ceil(self.scale)
+            self.surface.fill(self.colors[UNKNOWN_TILE if tile is None else tile].tolist(), Rect(self.tile_position(coord), (size, size)))
+            return
+        sprite = self.sprites.get(tilemap.get_tile(coord)) or self.unknown_sprite
+        self.surface.blit(sprite, self.tile_position(coord))
+
+    '''
+    Draws every tile in the bounds as a flat color, in a single surfarray write.
+    Each pixel takes the color of the last tile that covers it, as if the tiles were filled one by one.
+    '''
+    def draw_low_detail(self, tilemap: TilemapComponent):
+        if self.colors is None:
+            self.colors = average_tile_colors()
+
+        bounds = self.bounds
+        tiles = np.full((bounds.height, bounds.width), UNKNOWN_TILE, dtype=np.uint8)
+        inside = bounds.clip(Rect(0, 0, len(tilemap.map[0]), len(tilemap.map)))
+        tiles[inside.top - bounds.top:inside.bottom - bounds.top, inside.left - bounds.left:inside.right - bounds.left] = tilemap.region(inside)
+
+        # The tile covering each column and row of pixels
+        width, height = self.surface.get_size()
+        starts_x = [self.tile_position((x, bounds.top))[0] for x in range(bounds.left, bounds.right)]
+        starts_y = [self.tile_position((bounds.left, y))[1] for y in range(bounds.top, bounds.bottom)]
+        columns = np.searchsorted(starts_x, np.arange(width), side='right') - 1
+        rows = np.searchsorted(starts_y, np.arange(height), side='right') - 1
+
+        # surfarray is indexed [x, y]
+        surfarray.blit_array(self.surface, self.colors[tiles[rows][:, columns].T])
+
+
+'''
+Merges overlapping rects. They are swept from left to right, so each is only checked against the merged rects that reach it.
+A merged rect can still grow into one that was already passed, which only means those pixels are drawn twice.
+'''
+def merge_rects(rects: list[Rect]) -> list[Rect]:
+    merged: list[Rect] = []
+    active: list[Rect] = []
+    for rect in sorted(rects, key=lambda rect: rect.left):
+        rect = Rect(rect)
+        if any(other.right <= rect.left for other in active):
+            merged += [ other for other in active if other.right <= rect.left ]
+            active = [ other for other in active if other.right > rect.left ]
+
+        index = rect.collidelist(active)
+        while index != -1:
+            rect.union_ip(active.pop(index))
+            index = rect.collidelist(active)
+        active.append(rect)
+    return merged + active
+
+'''
+Works out the areas of the screen to redraw from a list of damaged rects.
+Past a number of rects, or a share of the screen, the whole screen is redrawn instead, as that is cheaper than many clipped passes.
+'''
+def resolve_damage(damage: list[Rect], screen_rect: Rect) -> list[Rect]:
+    if len(damage) > DAMAGE_RECT_LIMIT:
+        return [ Rect(screen_rect) ]
+
+    damage = [ rect.clip(screen_rect) for rect in merge_rects(damage) if rect.colliderect(screen_rect) ]
+    if sum(rect.width * rect.height for rect in damage) > screen_rect.width * screen_rect.height * DAMAGE_AREA_LIMIT:
+        return [ Rect(screen_rect) ]
+    return damage
+
+
+'''
+Culls the positions of a sprite batch, adding the visible ones (and their rects) to the layer batch.
+The batch is recorded as drawn once, under the bounding rect of its visible copies, so dirty rects track it as a whole.
+'''
+def draw_sprite_batch(e: Entity, asset_pipeline: AssetPipeline, offset: Vector2, scale: float, screen_rect: Rect,
+                      batch: list[tuple[Surface, Vector2]], rects: list[Rect], drawn: dict[Entity, tuple[Surface, Rect, list | None]]):
+    scaled_sprite = asset_pipeline.get_scaled(e.sprite_batch.surface, scale / TILE_SCALE)
+    sprite_size = scaled_sprite.get_size()
+    corner = offset - Vector2(sprite_size)/2
+    first = len(rects)
+    for position in e.sprite_batch.positions:
+        screen_pos = Vector2(position) * scale + corner
+        sprite_rect = Rect(screen_pos, sprite_size)
+        if screen_rect.colliderect(sprite_rect):
+            batch.append((scaled_sprite, screen_pos))
+            rects.append(sprite_rect)
+
+    if len(rects) > first:
+        drawn[e] = (scaled_sprite, rects[first].unionall(rects[first + 1:]), e.sprite_batch.positions)
+
 '''
 The sprite drawings system:
 Use the camera position to draw all entities with a sprite at their relative location.
+The tilemap is drawn from the camera's cached tile layer.
 '''
 def draw_sprite_system(group: EntityGroup):
 
@@ -74,31 +375,75 @@ def draw_sprite_system(group: EntityGroup):
     surface: Surface = camera.camera.surface
     offset, scale = camera.camera.get_screenspace_transform(camera.motion.position)
 
+    tile_layer: TileLayerComponent = camera.tile_layer
+    redrawn_tiles = tile_layer.update(tilemap, offset, scale)
+
+    # Sprites are culled against the screen, and submitted in one batch per layer (highest layer first)
     asset_pipeline = AssetPipeline.get_instance()
-    tile_size = Vector2(math.ceil(scale))
-    scaled_sprites = {key: pygame.transform.scale(sprite, tile_size) for key, sprite in TILE_SPRITES.items()}
-    unknown_sprite = pygame.transform.scale(asset_pipeline.get_image('tiles/unknown.png'), tile_size)
+    screen_rect = surface.get_rect()
+    render_list: RenderListComponent = camera.render_list
+    batches: list[list[tuple[Surface, Vector2]]] = []
+    batch_rects: list[list[Rect]] = []
+    drawn: dict[Entity, tuple[Surface, Rect, list | None]] = {}
+    for layer in reversed(render_list.layers):
+        batch: list[tuple[Surface, Vector2]] = []
+        rects: list[Rect] = []
+        for e in layer:
+            if hasattr(e, 'sprite_batch'):
+                draw_sprite_batch(e, asset_pipeline, offset, scale, screen_rect, batch, rects, drawn)
+                continue
 
-    
-    tile_center = Vector2(scale / 2)
-    for y in range(tilemap.bounds.left, tilemap.bounds.right):
-        for x in range(tilemap.bounds.top, tilemap.bounds.bottom):
-            tile = tilemap.get_tile((x,y))
-            scaled_sprite = scaled_sprites.get(tile) or unknown_sprite
-            screen_pos = Vector2(x,y) * scale + offset
-            surface.blit(scaled_sprite, screen_pos - tile_center)
-
-    for e in sorted((e for e in group.query('sprite', 'motion') if (e.motion.layer != None)), key = lambda e: -e.motion.layer):
-        
-        motion: MotionComponent = e.motion
-        sprite: SpriteComponent = e.sprite
-        
-        scaled_sprite = pygame.transform.scale_by(sprite.surface, scale / TILE_SCALE)
-        screen_pos = motion.position * scale + offset
-        sprite_center = Vector2(scaled_sprite.get_size())/2
-
-        # Note, we are ignoring any screen-space culling
-        surface.blit(scaled_sprite, screen_pos - sprite_center)
+            scaled_sprite = asset_pipeline.get_scaled(e.sprite.surface, scale / TILE_SCALE)
+            sprite_size = scaled_sprite.get_size()
+            screen_pos = e.motion.position * scale + offset - Vector2(sprite_size)/2
+            sprite_rect = Rect(screen_pos, sprite_size)
+
+            if screen_rect.colliderect(sprite_rect):
+                batch.append((scaled_sprite, screen_pos))
+                rects.append(sprite_rect)
+                drawn[e] = (scaled_sprite, sprite_rect, None)
+
+        batches.append(batch)
+        batch_rects.append(rects)
+
+    if not camera.camera.dirty_rects:
+        surface.blit(tile_layer.surface, tile_layer.position)
+        for batch in batches:
+            surface.blits(batch, doreturn=False)
+        return
+
+    # Redraw everything within the damaged areas: tiles that changed, and sprites that appeared, moved or disappeared
+    render_list.drawn, previous = drawn, render_list.drawn
+    damage = camera.camera.pending_damage
+    camera.camera.pending_damage = []
+    if redrawn_tiles is None:
+        damage.append(screen_rect)
+    else:
+        damage += redrawn_tiles
+    for e, (scaled_sprite, sprite_rect, positions) in drawn.items():
+        last = previous.pop(e, None)
+        if last is None or last[0] is not scaled_sprite or last[1] != sprite_rect or last[2] is not positions:
+            damage.append(sprite_rect)
+            if last:
+                damage.append(last[1])
+    damage += (sprite_rect for _, sprite_rect, _ in previous.values())
+
+    camera.camera.damage = resolve_damage(damage, screen_rect)
+    if camera.camera.damage == [screen_rect]:
+        surface.fill((0,0,0))
+        surface.blit(tile_layer.surface, tile_layer.position)
+        for batch in batches:
+            surface.blits(batch, doreturn=False)
+        return
+
+    # Only the sprites touching each damaged rect are submitted for it
+    for rect in camera.camera.damage:
+        surface.set_clip(rect)
+        surface.fill((0,0,0))
+        surface.blit(tile_layer.surface, tile_layer.position)
+        for batch, rects in zip(batches, batch_rects):
+            surface.blits([ batch[i] for i in rect.collidelistall(rects) ], doreturn=False)
+    surface.set_clip(None)
 
 def camera_update_system(group: EntityGroup):
     camera_entity = group.query_singleton('camera', 'motion')
@@ -112,17 +457,35 @@ def camera_update_system(group: EntityGroup):
     scale_size = min(camera.surface.get_width(), camera.surface.get_height())
     camera.scale = scale_size if tilemap.bounds.width == 0 else scale_size / tilemap.bounds.width
 
+    if camera_entity.tile_layer.is_stale(tilemap):
+        camera.mark_dirty()
+
+    camera.redraw = camera.dirty or not camera.render_on_change
+    camera.dirty = False
+
     
 
 '''
-Mounts the sprite drawing system, and adds a camera component for the viewport
+Mounts the sprite drawing system, and adds a camera component for the viewport.
+If render_on_change is set, the sprites are only drawn on frames where something visible changed.
+If dirty_rects is set, only the areas of the screen that changed are redrawn. See: CameraComponent
 '''
-def mount_sprite_system(group: EntityGroup, target: Surface):
+def mount_sprite_system(group: EntityGroup, target: Surface, render_on_change: bool = False, dirty_rects: bool = False):
     camera = Entity("camera")
-    camera.camera = CameraComponent(surface=target)
+    camera.camera = CameraComponent(surface=target, render_on_change=render_on_change, dirty_rects=dirty_rects)
+    camera.tile_layer = TileLayerComponent()
+    camera.render_list = RenderListComponent.from_layer_count(LAYER_COUNT)
     camera.motion = MotionComponent(position=Vector2(0,0))
     group.add(camera)
 
+    group.observe(camera.render_list.insert, camera.render_list.remove, 'sprite', 'motion')
+    group.observe(camera.render_list.insert_batch, camera.render_list.remove_batch, 'sprite_batch')
+
+    def on_sprite_changed(e: Entity):
+        camera.camera.mark_dirty()
+    group.observe(on_sprite_changed, on_sprite_changed, 'sprite', 'motion')
+    group.observe(on_sprite_changed, on_sprite_changed, 'sprite_batch')
+
     group.mount_system(camera_update_system)
-    group.mount_system(draw_sprite_system)
+    group.mount_system(draw_sprite_system, run_if('camera', 'redraw', True))
 
@@ -1,7 +1,10 @@
 from typing import Union
-from pygame import Color, Vector2, image, Rect
+import hashlib
+import os
+from pygame import Color, Surface, Vector2, image, Rect, surfarray
 from engine.assets import AssetPipeline
 from engine.ecs import enumerate_component, factory
+import numpy as np
 
 TILE_EARTH = 0
 TILE_WATER = 1
@@ -28,20 +31,30 @@ def rgb_key(rgba: tuple[int, int, int, int]):
 
     return key
 
-TILE_COLOR_MAP = {
-    rgb_key(Color('#67584b')): TILE_EARTH,
-    rgb_key(Color('#4772e5')): TILE_WATER,
-    rgb_key(Color('#5d330e')): TILE_MUD,
-    rgb_key(Color('#6ad127')): TILE_PLANT,
-    rgb_key(Color('#e04a09')): TILE_EMBER,
-    rgb_key(Color('#c5d5ff')): TILE_ICE,
-    rgb_key(Color('#9fa2aa')): TILE_ROCK,
-    rgb_key(Color('#df4a00')): TILE_LAVA,
-    rgb_key(Color('#56001a')): TILE_HELLSCAPE,
-    rgb_key(Color('#46403a')): TILE_ASH,
-    rgb_key(Color('#762981')): TILE_MARSH,
-    rgb_key(Color('#d30b91')): TILE_OOZE,
-}
+'''
+Packs an RGBA color into a single integer
+'''
+def pack_rgba(rgba: tuple[int, int, int, int]) -> int:
+    r, g, b, a = rgba
+    return (r << 24) | (g << 16) | (b << 8) | a
+
+TILE_COLORS = [
+    (Color('#67584b'), TILE_EARTH),
+    (Color('#4772e5'), TILE_WATER),
+    (Color('#5d330e'), TILE_MUD),
+    (Color('#6ad127'), TILE_PLANT),
+    (Color('#e04a09'), TILE_EMBER),
+    (Color('#c5d5ff'), TILE_ICE),
+    (Color('#9fa2aa'), TILE_ROCK),
+    (Color('#df4a00'), TILE_LAVA),
+    (Color('#56001a'), TILE_HELLSCAPE),
+    (Color('#46403a'), TILE_ASH),
+    (Color('#762981'), TILE_MARSH),
+    (Color('#d30b91'), TILE_OOZE),
+]
+
+TILE_COLOR_MAP = { rgb_key(color): tile for color, tile in TILE_COLORS }
+TILE_PACKED_COLOR_MAP = { pack_rgba(color): tile for color, tile in TILE_COLORS }
 
 asset_pipeline = AssetPipeline.get_instance()
 
@@ -61,47 +74,206 @@ TILE_SPRITES = {
 }
 
 '''
-Component that stores a tilemap
+Component that stores a tilemap.
+The map may either be nested lists, or a dense (height, width) uint8 numpy array. Both support the same accessors,
+but the bulk accessors (region, mask) return views rather than copies when the map is dense.
+The revision is incremented whenever a tile changes, so derived data can tell when it is stale.
+Consumers that need to know which tiles changed can watch the map instead. See: watch
 '''
 @enumerate_component("tilemap")
 class TilemapComponent():
     bounds: Rect
-    map: list[list[int]]
+    map: Tilemap | np.ndarray
+    dense: bool = False
+    revision: int = 0
+    watchers: list[set[tuple[int, int]]] = factory(list)
 
     def get_tile(self, coord: Union[Vector2, tuple[int, int]]):
-        if not self.contains(coord):
+        x, y = int(coord[0]), int(coord[1])
+        if not self.bounds.collidepoint(x, y):
             return None
-        
-        return self.map[int(coord[1])][int(coord[0])]
+
+        if self.dense:
+            return self.map.item(y, x)
+        return self.map[y][x]
     
     def set_tile(self, coord: Union[Vector2, tuple[int, int]], tile: Tile):
-        if not self.contains(coord):
+        x, y = int(coord[0]), int(coord[1])
+        if not self.bounds.collidepoint(x, y):
             return
 
-        self.map[int(coord[1])][int(coord[0])] = tile
+        if self.dense:
+            if self.map.item(y, x) == tile:
+                return
+            self.map[y, x] = tile
+        else:
+            row = self.map[y]
+            if row[x] == tile:
+                return
+            row[x] = tile
+        self.revision += 1
+        for changed in self.watchers:
+            changed.add((x, y))
+
+    '''
+    Vectorized form of set_tile, for arrays of x and y coordinates and the tiles to set them to.
+    '''
+    def set_tiles(self, xs: np.ndarray, ys: np.ndarray, tiles: np.ndarray):
+        inside = (xs >= self.bounds.left) & (xs < self.bounds.right) & (ys >= self.bounds.top) & (ys < self.bounds.bottom)
+        xs, ys, tiles = xs[inside], ys[inside], tiles[inside]
+        if self.dense:
+            current = self.map[ys, xs]
+        else:
+            current = np.array([ self.map[y][x] for x, y in zip(xs.tolist(), ys.tolist()) ], dtype=np.uint8)
+        changed = current != tiles
+        if not changed.any():
+            return
+
+        xs, ys, tiles = xs[changed], ys[changed], tiles[changed]
+        coords = list(zip(xs.tolist(), ys.tolist()))
+        if self.dense:
+            self.map[ys, xs] = tiles
+        else:
+            for (x, y), tile in zip(coords, tiles.tolist()):
+                self.map[y][x] = tile
+        self.revision += 1
+        for watcher in self.watchers:
+            watcher.update(coords)
+
+    '''
+    Returns a set that the coordinates of changed tiles will be added to.
+    The watcher is responsible for clearing it once the changes are handled.
+    '''
+    def watch(self) -> set[tuple[int, int]]:
+        changed = set()
+        self.watchers.append(changed)
+        return changed
 
     def contains(self, coord: Union[Vector2, tuple[int, int]]):
-        return self.bounds.contains(coord, (0, 0))
+        return self.bounds.collidepoint(int(coord[0]), int(coord[1]))
+
+    '''
+    Vectorized form of contains, for an (n, 2) array of coordinates. Returns a boolean array.
+    '''
+    def contains_many(self, coords: np.ndarray) -> np.ndarray:
+        coords = np.trunc(coords)
+        return (
+            (coords[:, 0] >= self.bounds.left) & (coords[:, 0] < self.bounds.right) &
+            (coords[:, 1] >= self.bounds.top) & (coords[:, 1] < self.bounds.bottom)
+        )
+
+    '''
+    Returns the whole map as a (height, width) array. This is a copy unless the map is dense.
+    '''
+    def as_array(self) -> np.ndarray:
+        if self.dense:
+            return self.map
+        return np.array(self.map, dtype=np.uint8)
+
+    '''
+    Returns the tiles within a rect (the bounds by default) as a (height, width) array, clipped to the map.
+    Index it with [y, x] relative to the top left of the (clipped) rect.
+    '''
+    def region(self, rect: Rect | None = None) -> np.ndarray:
+        rect = self.bounds if rect is None else rect
+        rect = rect.clip(Rect(0, 0, len(self.map[0]), len(self.map)))
+        if self.dense:
+            return self.map[rect.top:rect.bottom, rect.left:rect.right]
+        return np.array([row[rect.left:rect.right] for row in self.map[rect.top:rect.bottom]], dtype=np.uint8).reshape(rect.height, rect.width)
+
+    '''
+    Returns a boolean array of the tiles within a rect (the bounds by default) that match any of the given tiles.
+    '''
+    def mask(self, *tiles: Tile, rect: Rect | None = None) -> np.ndarray:
+        return np.isin(self.region(rect), tiles)
 
     @staticmethod
-    def from_map(map: Tilemap):
+    def from_map(map: Tilemap | np.ndarray, dense: bool = False):
         bounds = Rect(0, 0, 0, 0)
         bounds.center = (0, 0)
 
+        if dense or isinstance(map, np.ndarray):
+            map = np.asarray(map, dtype=np.uint8)
+            dense = True
+
         return TilemapComponent(
             map = map,
+            dense = dense,
             bounds = bounds
         )
 
 
-def parse_tile_map(image_path: str) -> Tilemap:
-    map_surface = AssetPipeline.get_instance().get_image(image_path)
-    map: Tilemap = list()
-    for y in range(map_surface.get_height()):
-        map.append(list())
-        for x in range(map_surface.get_width()):
-            tile_color = rgb_key(map_surface.get_at((x, y)))
-            tile = TILE_COLOR_MAP.get(tile_color) or TILE_EARTH
-            map[y].append(tile)
-    
+'''
+Classifies every pixel of a map image in one pass.
+Pixels are packed into RGBA integers, and each distinct color is mapped to a tile through a lookup table.
+Returns the (height, width) tile array, and the counts of any unknown colors (which become TILE_EARTH).
+'''
+def load_tile_array(map_surface: Surface) -> tuple[np.ndarray, dict[int, int]]:
+    rgb = surfarray.array3d(map_surface).astype(np.uint32)
+    alpha = surfarray.array_alpha(map_surface).astype(np.uint32)
+    packed = (rgb[:, :, 0] << 24) | (rgb[:, :, 1] << 16) | (rgb[:, :, 2] << 8) | alpha
+
+    colors, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+    lookup = np.array([TILE_PACKED_COLOR_MAP.get(color, TILE_EARTH) for color in colors.tolist()], dtype=np.uint8)
+    unknown = { color: count for color, count in zip(colors.tolist(), counts.tolist()) if color not in TILE_PACKED_COLOR_MAP }
+
+    # surfarray is indexed [x, y], tilemaps are [y, x]
+    tiles = lookup[inverse.reshape(packed.shape)]
+    return np.ascontiguousarray(tiles.T), unknown
+
+
+'''
+Returns the paths of the baked tile array, and of the key it was baked with, for a map image on disk
+'''
+def baked_map_paths(source_path: str) -> tuple[str, str]:
+    base, _ = os.path.splitext(source_path)
+    return base + '.tiles.npy', base + '.tiles.key'
+
+'''
+Returns the key a baked map must match to be used: a hash of the source image, and of the tile colors
+'''
+def baked_map_key(source_path: str) -> str:
+    digest = hashlib.sha1()
+    with open(source_path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(repr(sorted(TILE_COLOR_MAP.items())).encode())
+    return digest.hexdigest()
+
+'''
+Parses a map image, and writes the tile array next to it so later loads can skip decoding.
+'''
+def bake_tile_map(image_path: str) -> np.ndarray:
+    asset_pipeline = AssetPipeline.get_instance()
+    source_path = asset_pipeline.get_path(image_path)
+    tiles_path, key_path = baked_map_paths(source_path)
+
+    map, unknown = load_tile_array(asset_pipeline.get_image(image_path))
+    if len(unknown):
+        colors = ', '.join(f'#{color:08x} ({count})' for color, count in unknown.items())
+        print(f'Unknown tile colors in {image_path}, using earth: {colors}')
+
+    try:
+        np.save(tiles_path, map)
+        with open(key_path, 'w') as f:
+            f.write(baked_map_key(source_path))
+    except OSError:
+        pass # The assets may be read only. The map is still usable.
+
     return map
+
+'''
+Loads the tiles for a map image, using the baked tile array if it is up to date.
+The baked array is memory mapped copy-on-write, so changes to the tilemap are never written back.
+See: bake_maps.py to rebuild all of them.
+'''
+def parse_tile_map(image_path: str) -> np.ndarray:
+    source_path = AssetPipeline.get_instance().get_path(image_path)
+    tiles_path, key_path = baked_map_paths(source_path)
+    try:
+        with open(key_path) as f:
+            if f.read() == baked_map_key(source_path):
+                return np.load(tiles_path, mmap_mode='c')
+    except (OSError, ValueError):
+        pass # Missing or corrupt, so rebake it
+
+    return bake_tile_map(image_path)
@@ -1,4 +1,4 @@
-from engine.ecs import Entity, EntityGroup, enumerate_component, factory
+from engine.ecs import Entity, EntityGroup, enumerate_component, factory, run_if
 from enum import Enum
 
 
@@ -20,18 +20,18 @@ class TurnComponent():
 
 
 '''
-Update the time step
+Update the time step.
+Only run once the turn is no longer waiting on user input.
 '''
 def update_turn_system(group: EntityGroup):
     
     turn: TurnComponent = group.query_singleton("turn").turn
 
-    if not turn.waiting:
-        turn.state += 1
-        if turn.state == TURN_COMPLETE:
-            turn.state = TURN_PLAYER
-            turn.waiting = True
-            turn.number += 1
+    turn.state += 1
+    if turn.state == TURN_COMPLETE:
+        turn.state = TURN_PLAYER
+        turn.waiting = True
+        turn.number += 1
     
 
 
@@ -42,4 +42,4 @@ def mount_turn_system(group: EntityGroup):
     e = Entity("turn")
     e.turn = TurnComponent()
     group.add(e)
-    group.mount_system(update_turn_system)
+    group.mount_system(update_turn_system, run_if('turn', 'waiting', False))
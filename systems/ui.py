@@ -1,26 +1,47 @@
 import pygame
+from engine.assets import AssetPipeline
 from engine.ecs import Entity, EntityGroup, enumerate_component
 from systems.motion import MotionComponent
+from systems.sprites import CameraComponent
 
 
 @enumerate_component("ui")
 class UIComponent:
     identifier: str = None
     text: str
+    drawn_text: str = None # The text the surface was rendered from
+    drawn_rect: pygame.Rect = None # The screen area of the drawn text
+    surface: pygame.Surface = None
 
 @enumerate_component("font")
 class FontComponent:
     font: pygame.font.Font
 
+TEXT_COLOR = (255,255,255)
+
+'''
+Draws the UI text, if the camera is redrawing this frame.
+Text is only rendered when it changes, and the change is reported to the camera as damage.
+'''
 def ui_update_system(group: EntityGroup):
-    camera_surface = group.query_singleton('camera').camera.surface
+    camera: CameraComponent = group.query_singleton('camera').camera
     font: pygame.font.Font = group.query_singleton('font').font.font
+    asset_pipeline = AssetPipeline.get_instance()
 
     for ui_entity in group.query('ui', 'motion'):
         ui: UIComponent = ui_entity.ui
         motion: MotionComponent = ui_entity.motion
 
-        camera_surface.blit(font.render(ui.text, True, (255,255,255)), motion.position)
+        if ui.text != ui.drawn_text:
+            if ui.drawn_rect:
+                camera.add_damage(ui.drawn_rect)
+            ui.drawn_text = ui.text
+            ui.surface = asset_pipeline.render_text(font, ui.text, TEXT_COLOR)
+            ui.drawn_rect = pygame.Rect(motion.position, ui.surface.get_size())
+            camera.add_damage(ui.drawn_rect)
+
+        if camera.redraw:
+            camera.blit(ui.surface, motion.position)
 
 
 def mount_ui_system(group: EntityGroup):
@@ -31,4 +52,13 @@ def mount_ui_system(group: EntityGroup):
 
     group.add(font_entity)
 
+    # New text is picked up by the update system, but removed text has to be cleared
+    def on_ui_removed(e: Entity):
+        camera: CameraComponent = group.query_singleton('camera').camera
+        if e.ui.drawn_rect:
+            camera.add_damage(e.ui.drawn_rect)
+        else:
+            camera.mark_dirty()
+    group.observe(None, on_ui_removed, 'ui', 'motion')
+
     group.mount_system(ui_update_system)
\ No newline at end of file